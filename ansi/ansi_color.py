@@ -1,4 +1,9 @@
-import re
+import functools
+
+try:
+    from .ansi_tokenizer import AnsiTokenizer, TEXT, SGR, CR, LF
+except ImportError:
+    from ansi_tokenizer import AnsiTokenizer, TEXT, SGR, CR, LF
 
 
 XTERM_COLORS_256 = [
@@ -38,176 +43,165 @@ XTERM_COLORS_256 = [
     '#a8a8a8', '#b2b2b2', '#bcbcbc', '#c6c6c6', '#d0d0d0', '#dadada', '#e4e4e4', '#eeeeee'
 ]
 
+# bound on the caches of decoded SGR parameters
+SGR_CACHE_SIZE = 1024
 
-class AnsiColor:
-    def __init__(self):
-        self._ansi_color_unsupported_regex_str = r'\x1b\[(0;)?[25689]m'
-        self._ansi_color_regex_str = r'(?:\x1b\[([0-9;]*)m)+\x0f?'
-        self._ansi_charset_regex_str = r'\x1b\[(|)]\w?'
-        self._ansi_null_regex_str = r'\x00'
-        self._ansi_color_regex = re.compile(self._ansi_color_regex_str, flags=re.IGNORECASE)
-        self._ansi_color_unsupported_regex = re.compile(self._ansi_color_unsupported_regex_str, flags=re.IGNORECASE)
-        self._ansi_charset_regex = re.compile(self._ansi_charset_regex_str, flags=re.IGNORECASE)
-        self._ansi_null_regex = re.compile(self._ansi_null_regex_str, flags=re.IGNORECASE)
-        self._style = self._default_style()
-        self._style_changed = False
-
-    def _default_style(self):
-        style = {
-            'bold': False,
-            'italic': False,
-            'underline': False,
-            'fg': None,
-            'bg': None,
-        }
-        return style
 
-    @staticmethod
-    def _xterm_color(code, bright=False):
-        num = int(code[-1])
-        if bright:
-            num += 8
-        if not (0 <= num <= 255):
-            return None
-        color = XTERM_COLORS_256[num]
-        return color
-
-    @staticmethod
-    def _rgb_to_hex(r, g, b):
-        return '#{:02x}{:02x}{:02x}'.format(r, g, b)
-
-    def _decode_multi(self, idx, code_split):
-        i = idx+1
-        if i > len(code_split):
-            return idx, None
-        item = code_split[i]
-        if item == '5':  # 256
-            i1 = i+1
-            if i1 > len(code_split):
-                return i1, None
-            n = int(code_split[i1])
-            color = XTERM_COLORS_256[n]
-            i2 = i1+1
-            if i2 >= len(code_split):
-                return i1, color
-            item = code_split[i2]
-            if item == '0':
-                return i2, color
-            else:
-                return i1, color
-        elif item == '2':  # rgb
-            i1 = i+1
-            if i1 >= len(code_split):
-                return i, None
-            r = code_split[i1]
-            i2 = i1+1
-            if i2 >= len(code_split):
-                return i1, None
-            g = code_split[i2]
-            i3 = i2+1
-            if i3 >= len(code_split):
-                return i2, None
-            b = code_split[i3]
-            color = self._rgb_to_hex(r, g, b)
-            item = code_split[i3]
-            if item == '0':
-                return i3, color
-            else:
-                return i2, color
-        else:
-            return idx, None
+class AnsiStyle:
+    """Immutable text style. get() returns one shared instance per
+    combination, so styles compare by identity, are cheap dict keys and
+    handing one out for every text section allocates nothing."""
+    __slots__ = ('bold', 'italic', 'underline', 'fg', 'bg', 'scope')
+    _interned = {}
+
+    def __init__(self, bold, italic, underline, fg, bg):
+        set_attr = super(AnsiStyle, self).__setattr__
+        set_attr('bold', bold)
+        set_attr('italic', italic)
+        set_attr('underline', underline)
+        set_attr('fg', fg)
+        set_attr('bg', bg)
+        set_attr('scope', f"{fg}{bg}")
 
-    def _decode(self, ansi_color_text):
-        ret = False
-        style = {
+    def __setattr__(self, name, value):
+        raise AttributeError('AnsiStyle is immutable')
+
+    def __repr__(self):
+        return (f'AnsiStyle(bold={self.bold}, italic={self.italic}, underline={self.underline}, '
+                f'fg={self.fg}, bg={self.bg})')
+
+    @classmethod
+    def get(cls, bold=False, italic=False, underline=False, fg=None, bg=None):
+        key = (bold, italic, underline, fg, bg)
+        style = cls._interned.get(key)
+        if style is None:
+            style = cls._interned.setdefault(key, cls(*key))
+        return style
+
+    def updated(self, changes):
+        """returns the style with the (name, value) pairs in changes applied"""
+        values = {
+            'bold': self.bold,
+            'italic': self.italic,
+            'underline': self.underline,
+            'fg': self.fg,
+            'bg': self.bg,
         }
-        code_split = ansi_color_text.split(';')
-        idx = 0
-        while True:
-            if idx >= len(code_split):
-                break
-            item = code_split[idx]
-            if item in ('0','00') or len(code_split) == 1 and item == '':
-                style = self._default_style()
-                ret = True
-            elif item in ('1','01'):
-                style['bold'] = True
-                ret = True
-            elif item in ('3','03'):
-                style['italic'] = True
-                ret = True
-            elif item in ('4','04'):
-                style['underline'] = True
-                ret = True
-            elif item in ('7','07'):
-                style['fg'] = self._xterm_color('0', style.get('bold',False))
-                style['bg'] = self._xterm_color('7', style.get('bold',False))
-                ret = True
-            elif '30' <= item <= '37':
-                style['fg'] = self._xterm_color(item, style.get('bold',False))
-                ret = True
-            elif '40' <= item <= '47':
-                style['bg'] = self._xterm_color(item, style.get('bold',False))
-                ret = True
-            elif '90' <= item <= '97':
-                style['fg'] = self._xterm_color(item, bright=True)
-                ret = True
-            elif '100' <= item <= '107':
-                style['bg'] = self._xterm_color(item, bright=True)
-                ret = True
-            elif item == '38':
-                multi = 'fg'
-                idx, color = self._decode_multi(idx, code_split)
-                if color is not None:
-                    style[multi] = color
-                    ret = True
-                continue
-            elif item == '48':
-                multi = 'bg'
-                idx, color = self._decode_multi(idx, code_split)
-                if color is not None:
-                    style[multi] = color
-                    ret = True
-                continue
-            idx += 1
-        return ret, style
+        values.update(changes)
+        return self.get(**values)
 
-    def run(self, text):
-        # print('ansicolor text')
-        # print(text)
-        # print(text.encode())
 
-        text = self._ansi_charset_regex.sub('', text)
-        text = self._ansi_null_regex.sub('', text)
+DEFAULT_STYLE = AnsiStyle.get()
+_RESET = (('bold', False), ('italic', False), ('underline', False), ('fg', None), ('bg', None))
+
+# code: (name, value)
+_SGR_ATTRIBUTES = {
+    1: ('bold', True),
+    3: ('italic', True),
+    4: ('underline', True),
+    22: ('bold', False),
+    23: ('italic', False),
+    24: ('underline', False),
+    39: ('fg', None),
+    49: ('bg', None),
+}
+# code: (name, xterm colour index, brightened by a bold earlier in the sequence)
+_SGR_COLORS = {}
+for _i in range(8):
+    _SGR_COLORS[30 + _i] = ('fg', _i, True)
+    _SGR_COLORS[40 + _i] = ('bg', _i, True)
+    _SGR_COLORS[90 + _i] = ('fg', _i + 8, False)
+    _SGR_COLORS[100 + _i] = ('bg', _i + 8, False)
+# 38;5;n or 38;2;r;g;b, 58 (underline colour) is parsed and dropped
+_SGR_EXTENDED = {38: 'fg', 48: 'bg', 58: None}
+# not drawn, shown as bold when they are the whole sequence
+_SGR_UNSUPPORTED = (2, 5, 6, 8, 9)
 
-        if not self._style_changed and not self._ansi_color_regex.search(text):
-            return False, [[text, None]]
 
-        text = self._ansi_color_unsupported_regex.sub('\x1b[1m', text)
+def _rgb_to_hex(r, g, b):
+    return '#{:02x}{:02x}{:02x}'.format(r, g, b)
 
+
+@functools.lru_cache(maxsize=SGR_CACHE_SIZE)
+def decode_sgr(ansi_color_text):
+    """returns the (name, value) changes made by an SGR parameter string,
+       a reset expands to every attribute. Cached, shells repeat the same
+       few sequences endlessly."""
+    codes = [int(code) if code else 0 for code in ansi_color_text.split(';')]
+    if codes[-1] in _SGR_UNSUPPORTED and (len(codes) == 1 or codes == [0, codes[-1]]):
+        codes[-1] = 1
+    changes = {}
+    i = 0
+    n = len(codes)
+    while i < n:
+        code = codes[i]
+        i += 1
+        if code == 0:
+            changes = dict(_RESET)
+        elif code in _SGR_ATTRIBUTES:
+            name, value = _SGR_ATTRIBUTES[code]
+            changes[name] = value
+        elif code in _SGR_COLORS:
+            name, index, is_bold_bright = _SGR_COLORS[code]
+            if is_bold_bright and changes.get('bold'):
+                index += 8
+            changes[name] = XTERM_COLORS_256[index]
+        elif code == 7:  # reverse video, drawn as black on white
+            bright = 8 if changes.get('bold') else 0
+            changes['fg'] = XTERM_COLORS_256[bright]
+            changes['bg'] = XTERM_COLORS_256[7 + bright]
+        elif code == 27:
+            changes['fg'] = None
+            changes['bg'] = None
+        elif code in _SGR_EXTENDED:
+            name = _SGR_EXTENDED[code]
+            mode = codes[i] if i < n else None
+            if mode == 5 and i + 1 < n:
+                index = codes[i + 1]
+                i += 2
+                if name and index < len(XTERM_COLORS_256):
+                    changes[name] = XTERM_COLORS_256[index]
+            elif mode == 2 and i + 3 < n:
+                r, g, b = codes[i + 1:i + 4]
+                i += 4
+                if name and max(r, g, b) <= 255:
+                    changes[name] = _rgb_to_hex(r, g, b)
+            else:
+                break  # malformed, the rest can not be trusted
+    return tuple(changes.items())
+
+
+class AnsiColor:
+    def __init__(self):
+        self._tokenizer = AnsiTokenizer()
+        self._style = DEFAULT_STYLE
+        self._transitions = {}  # (style, SGR parameter string): style
+
+    @property
+    def style(self):
+        """current AnsiStyle, None while it is the default"""
+        return self._style if self._style is not DEFAULT_STYLE else None
+
+    def apply_sgr(self, ansi_color_text):
+        """updates the current style from the parameters of one SGR sequence"""
+        key = (self._style, ansi_color_text)
+        style = self._transitions.get(key)
+        if style is None:
+            changes = decode_sgr(ansi_color_text)
+            style = self._style.updated(changes) if changes else self._style
+            if len(self._transitions) >= SGR_CACHE_SIZE:
+                self._transitions.clear()
+            self._transitions[key] = style
+        self._style = style
+
+    def run(self, text):
+        """splits text into [text, style] sections, dropping escape sequences"""
         text_sections = []
-        while True:
-            if not len(text):
-                break
-            m = self._ansi_color_regex.search(text)
-            if not m:
-                break
-            start_index = m.start()
-            prefix = text[:start_index]
-            if len(prefix):
-                style = self._style.copy() if self._style_changed else None
-                text_sections.append([prefix, style])
-            text = text[m.end():]
-
-            ansi_color_text = m[1]
-            ret, current_style = self._decode(ansi_color_text)
-            if not ret:
-                continue
-            self._style.update(current_style)
-            self._style_changed = self._style != self._default_style()
-        if len(text):
-            style = self._style.copy() if self._style_changed else None
-            text_sections.append([text, style])
+        for kind, value, _ in self._tokenizer.feed(text):
+            if kind in (TEXT, CR, LF):
+                text_sections.append([value, self.style])
+            elif kind == SGR:
+                self.apply_sgr(value)
         return True, text_sections
 
 """
@@ -216,6 +210,57 @@ https://www.tweaking4all.com/software/linux-software/xterm-color-cheat-sheet/
 """
 
 
+def _sample_ls_color(n_lines=2000):
+    """`ls -l --color` of a large directory"""
+    colors = ['01;34', '01;32', '01;36', '00', '01;31', '38;5;208', '40;33;01']
+    lines = []
+    for i in range(n_lines):
+        color = colors[i % len(colors)]
+        lines.append(f'-rw-r--r--  1 user user {i * 37:>8} Nov 20 15:59 \x1b[0m\x1b[{color}mfile_{i}.txt\x1b[0m\r\n')
+    return ''.join(lines)
+
+def _sample_git_log_graph(n_commits=1000):
+    """`git log --graph --color --oneline --decorate`"""
+    graph = ['\x1b[31m|\x1b[m ', '\x1b[31m|\x1b[m \x1b[32m|\x1b[m ', '\x1b[31m|\x1b[m\x1b[33m/\x1b[m ']
+    lines = []
+    for i in range(n_commits):
+        lines.append(f'* {graph[i % 3]}\x1b[33m{i:07x}\x1b[m\x1b[33m (\x1b[m\x1b[1;36mHEAD -> \x1b[m\x1b[1;32mmaster\x1b[m'
+                     f'\x1b[33m)\x1b[m Commit message number {i}\r\n')
+    return ''.join(lines)
+
+def _sample_bat(n_lines=2000):
+    """`bat --color=always` of python source, truecolour"""
+    tokens = [('38;2;249;38;114', 'def'), ('38;2;166;226;46', 'name'), ('38;2;248;248;242', '(self, x):'),
+              ('38;2;117;113;94', '# comment'), ('38;2;230;219;116', '"string"'), ('38;2;174;129;255', '42')]
+    lines = []
+    for i in range(n_lines):
+        line = ' '.join(f'\x1b[{code}m{word}' for code, word in tokens[i % 3:i % 3 + 4])
+        lines.append(f'\x1b[38;5;238m{i:>5}\x1b[0m \x1b[38;5;238m│\x1b[0m {line}\x1b[0m\r\n')
+    return ''.join(lines)
+
+def _bench_decode():
+    """AnsiColor throughput, and SGR decoding with and without the cache"""
+    import time
+
+    for name, sample in (('ls --color', _sample_ls_color()),
+                         ('git log --graph', _sample_git_log_graph()),
+                         ('bat', _sample_bat())):
+        n_repeat = 10
+        params = [value for kind, value, _ in AnsiTokenizer().feed(sample) if kind == SGR]
+        start = time.perf_counter()
+        for _ in range(n_repeat):
+            AnsiColor().run(sample)
+        elapsed = time.perf_counter() - start
+        mb_s = len(sample) * n_repeat / elapsed / 1024 / 1024
+        timings = []
+        for decode in (decode_sgr.__wrapped__, decode_sgr):
+            start = time.perf_counter()
+            for _ in range(n_repeat):
+                for param in params:
+                    decode(param)
+            timings.append((time.perf_counter() - start) / (n_repeat * len(params)) * 1e9)
+        print(f'{name:>16}: {mb_s:6.1f} MB/s, {len(params)} sgr, decode {timings[0]:6.0f} ns uncached {timings[1]:4.0f} ns cached')
+
 def main():
     handler = AnsiColor()
     text = '\x1b[0;7m\x0f    PID USER      PRI  NI  VIRT   RES   SHR S CPU% MEM%\xc3\xa2-\xc2\xbd  TIME+  Command        \x1b[10;1H   2350 root       20   0 3034M  689M  158M S  0.0  4.4  0:21.37 /usr/local/bin/\x1b[11;4H\x1b[m\x0f3534 \x1b[0m\x0froot      \x1b[m\x0f 20   0 \x1b[0;1m\x0f3034M  689M  158M \x1b[m\x0fS  0.0  4.4  0:00.00 \x1b[0;1m\x0f/usr/local/bin/\x1b[12;4H\x1b[m\x0f9593 \x1b[0m\x0froot      \x1b[m\x0f 20   0 \x1b[0;1m\x0f3034M  689M  158M \x1b[m\x0fS  0.0  4.4  0:00.05 \x1b[0;1m\x0f/usr/local/bin/\x1b[13;3H\x1b[m\x0f10000 \x1b[0m\x0froot      \x1b[m\x0f 20   0 \x1b[0;1m\x0f3034M  689M  158M \x1b[m\x0fS  0.0  4.4  0:00.04 \x1b[0;1m\x0f/usr/local/bin/\x1b[14;3H\x1b[m\x0f13123 \x1b[0m\x0froot      \x1b[m\x0f 20   0 \x1b[0;1m\x0f3034M  689M  158M \x1b[m\x0fS  0.0  4.4  0:00.05 \x1b[0;1m\x0f/usr/local/bin/\x1b[15;3H'
@@ -229,5 +274,22 @@ def main():
     for a in text_sections:
         print(a)
 
+    # complete SGR set
+    assert decode_sgr('300') == ()
+    assert decode_sgr('38;2;255;95;0') == (('fg', '#ff5f00'),)
+    assert decode_sgr('38;5;1') == (('fg', '#cd0000'),)
+    assert decode_sgr('1;31') == (('bold', True), ('fg', '#ff0000'))
+    assert decode_sgr('22;23;24;39;49') == (('bold', False), ('italic', False), ('underline', False), ('fg', None), ('bg', None))
+    assert decode_sgr('97;104') == (('fg', '#ffffff'), ('bg', '#5c5cff'))
+    assert decode_sgr('9') == (('bold', True),)
+    handler = AnsiColor()
+    handler.apply_sgr('1;38;2;0;0;1')
+    handler.apply_sgr('22')
+    assert handler.style is AnsiStyle.get(fg='#000001')
+    handler.apply_sgr('39')
+    assert handler.style is None
+    print('ok')
+    _bench_decode()
+
 if __name__ == '__main__':
     main()
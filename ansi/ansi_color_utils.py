@@ -4,11 +4,21 @@ import os
 import json
 import re
 import types
+import hashlib
+import threading
+import time
 
-ANSI_COLOR_DIR = 'User/SublimeREPL-ssh'
+from .ansi_color import XTERM_COLORS_256
+
+ANSI_COLOR_DIR = 'User/SublimeREPL-ssh/ansi'
+# new colour rules are written to the scheme file at most this often
+COLOR_SCHEME_WRITE_INTERVAL = 0.5  # seconds
 comment_regex = re.compile(r'\/\/.*$\r?\n?', re.MULTILINE)
 comma_regex = re.compile(r',(\s*[\]|}])', re.MULTILINE)
 
+_color_schemes = {}  # digest: AnsiColorScheme in use by at least one view
+_color_schemes_lock = threading.Lock()
+
 
 def _sanitize_json_quotes_comments_commas(text):
     text = text.replace("'", '"')
@@ -27,31 +37,157 @@ def _get_color_scheme_rules(color_schema_text):
     rules = color_scheme_json.get('rules', [])
     return rules
 
-def _set_color_scheme(self):
-    self._view.settings().set("color_scheme", f"Packages/{self._cs_file_relative}")
+def _alternate_background(background):
+    """the view background changed by one step, so a region without a
+       background colour is still drawn"""
+    if background[-1].lower() == 'f':
+        char = ord(background[-1])-1
+    else:
+        char = ord(background[-1])+1
+    return f'{background[:-1]}{chr(char)}'
 
-def init_ansi_color(self):
-    self._set_color_scheme = types.MethodType(_set_color_scheme, self)
-    self._cs_file_relative = f"{ANSI_COLOR_DIR}/{self.repl.id}.sublime-color-scheme"
-    self._cs_file = os.path.join(sublime.packages_path(), self._cs_file_relative)
+def color_scheme_rule(scope, fg, bg, background):
+    rule = {'scope': scope}
+    if fg:
+        rule['foreground'] = fg
+    rule['background'] = bg if bg else _alternate_background(background)
+    return rule
+
+def xterm_palette_rules(background):
+    """rules for every xterm 256 colour as a foreground or background alone"""
     rules = []
+    for color in dict.fromkeys(XTERM_COLORS_256):
+        rules.append(color_scheme_rule(f"{color}None", color, None, background))
+        rules.append(color_scheme_rule(f"None{color}", None, color, background))
+    return rules
+
+def _color_scheme_file(digest):
+    """returns the scheme file path relative to Packages, and absolute"""
+    file_relative = f"{ANSI_COLOR_DIR}/{digest}.sublime-color-scheme"
+    return file_relative, os.path.join(sublime.packages_path(), file_relative)
+
+
+class AnsiColorScheme:
+    """Generated colour scheme shared by every repl view with the same base
+    scheme and palette setting, named after a digest of both.
+    Rules for new colours are added in memory and the file is rewritten
+    later, so a burst of new colours costs one reload."""
+
+    def __init__(self, digest, color_scheme):
+        self.digest = digest
+        self.file_relative, self.file = _color_scheme_file(digest)
+        self._color_scheme = color_scheme
+        self._scopes = {rule.get('scope') for rule in color_scheme['rules']}
+        self._views = {}  # view id: view using this scheme
+        self._lock = threading.Lock()
+        self._is_write_scheduled = False
+        self._last_write = 0
+
+    def add_styles(self, styles):
+        """adds a rule for each (scope, style) not in the scheme yet"""
+        with self._lock:
+            background = self._color_scheme['globals']['background']
+            is_changed = False
+            for scope, style in styles:
+                if scope in self._scopes:
+                    continue
+                self._color_scheme['rules'].append(color_scheme_rule(scope, style.fg, style.bg, background))
+                self._scopes.add(scope)
+                is_changed = True
+            if not is_changed or self._is_write_scheduled:
+                return
+            self._is_write_scheduled = True
+            delay = max(0, self._last_write + COLOR_SCHEME_WRITE_INTERVAL - time.monotonic())
+        sublime.set_timeout(self._write, int(delay * 1000))
+
+    def _write(self):
+        with self._lock:
+            self._is_write_scheduled = False
+            self._last_write = time.monotonic()
+            text = json.dumps(self._color_scheme)
+            views = list(self._views.values())
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        with open(self.file, 'w') as f:
+            f.write(text)
+        for view in views:
+            view.settings().set('color_scheme', view.settings().get('color_scheme'))
+
+
+def _base_color_scheme(view):
+    """returns (path, text) of the colour scheme view is drawn with"""
     try:
-        color_scheme_path = self._view.style_for_scope("source_file")['source_file']
+        color_scheme_path = view.style_for_scope("source_file")['source_file']
         if color_scheme_path.startswith('Packages'):
             color_scheme_path = color_scheme_path[len('Packages')+1:]
             color_scheme_path = os.path.join(sublime.packages_path(), color_scheme_path)
         with open(color_scheme_path, 'r') as f:
             color_schema_text = f.read()
-        rules = _get_color_scheme_rules(color_schema_text)
+        return color_scheme_path, color_schema_text
     except Exception as e:
         print(e)
+    return None, None
+
+def acquire_color_scheme(view, palette=False):
+    """returns the AnsiColorScheme for view's base scheme, generating it
+       only if no view uses it yet and no earlier copy is on disk"""
+    color_scheme_path, color_schema_text = _base_color_scheme(view)
+    globals_ = view.style()
+    key = json.dumps([color_scheme_path, color_schema_text, globals_, bool(palette)], sort_keys=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    with _color_schemes_lock:
+        color_scheme = _color_schemes.get(digest)
+        if color_scheme is None:
+            color_scheme = _load_color_scheme(digest, color_schema_text, globals_, palette)
+            _color_schemes[digest] = color_scheme
+        color_scheme._views[view.id()] = view
+    return color_scheme
+
+def _load_color_scheme(digest, color_schema_text, globals_, palette):
+    _, color_scheme_file = _color_scheme_file(digest)
+    try:
+        # rules added by earlier sessions are kept
+        with open(color_scheme_file, 'r') as f:
+            return AnsiColorScheme(digest, json.load(f))
+    except (OSError, ValueError):
+        pass
+    rules = []
+    if color_schema_text is not None:
+        try:
+            rules = _get_color_scheme_rules(color_schema_text)
+        except Exception as e:
+            print(e)
     color_scheme = {
         "author": "Auto-generated by SublimeREPL-ssh plugin",
-        "globals": self._view.style(),
+        "globals": globals_,
         "name": "AnsiColor",
         "rules": rules,
     }
-    os.makedirs(os.path.dirname(self._cs_file), exist_ok=True)
-    with open(self._cs_file,'w') as f:
+    if palette:
+        rules.extend(xterm_palette_rules(globals_['background']))
+    os.makedirs(os.path.dirname(color_scheme_file), exist_ok=True)
+    with open(color_scheme_file, 'w') as f:
         json.dump(color_scheme, f)
+    return AnsiColorScheme(digest, color_scheme)
+
+def release_color_scheme(view):
+    """drops view's reference, a scheme no view uses is forgotten but its
+       file is left for the next view with the same base scheme"""
+    with _color_schemes_lock:
+        for digest, color_scheme in list(_color_schemes.items()):
+            if color_scheme._views.pop(view.id(), None) is not None and not color_scheme._views:
+                del _color_schemes[digest]
+
+def _set_color_scheme(self):
+    self._view.settings().set("color_scheme", f"Packages/{self._cs_file_relative}")
+
+def _release_color_scheme(self):
+    release_color_scheme(self._view)
+
+def init_ansi_color(self, palette=False):
+    self._set_color_scheme = types.MethodType(_set_color_scheme, self)
+    # kept in memory, AnsiSublimeRegions adds rules for new colours to it
+    self._cs_scheme = acquire_color_scheme(self._view, palette)
+    self._cs_file_relative = self._cs_scheme.file_relative
+    self._cs_file = self._cs_scheme.file
+    self.call_on_close.append(_release_color_scheme)
     sublime.set_timeout(self._set_color_scheme, 500)
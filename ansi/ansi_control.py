@@ -1,12 +1,13 @@
-import re
-
 try:
-    from .ansi_regex import ANSI_ESCAPE_8BIT_REGEX, ANSI_ESCAPE_ALLOWCOLOR_REGEX
     from .ansi_color import AnsiColor
+    from .ansi_screen import AnsiScreen, _line_starts
+    from .ansi_tokenizer import AnsiTokenizer, TEXT, SGR, CSI, CR, LF
     from .ansi_sublime_regions import AnsiSublimeRegions
 except ImportError:
-    from ansi_regex import ANSI_ESCAPE_8BIT_REGEX, ANSI_ESCAPE_ALLOWCOLOR_REGEX
     from ansi_color import AnsiColor
+    from ansi_screen import AnsiScreen, _line_starts
+    from ansi_tokenizer import AnsiTokenizer, TEXT, SGR, CSI, CR, LF
+    from ansi_spans import AnsiSpans
 
 
 class AnsiControl:
@@ -16,24 +17,9 @@ class AnsiControl:
         self._terminal_height = terminal_height
         self._limit_cursor_up = limit_cursor_up
         self._cursor_pos = 0  # 1-indexed
-        self._ansi_csi_regex_str = r'\x1b\[(\??\d*[;|\d*]*)((?!m)[a-zA-Z])'
-        self._carriage_return_str = r'\r'  # \x0d
-        self._newline_regex_str = r'\n'  # \x0a
-        self._cursor_regex_str = f'(?:{self._ansi_csi_regex_str}|{self._carriage_return_str})'
-        self._cursor_w_newline_regex_str = f'(?:{self._ansi_csi_regex_str}|{self._carriage_return_str}|{self._newline_regex_str})'
-        self._clear_regex_str = r'\x1b\[J\x00+'
-        self._endash_regex_str = r'\xe2\x80\x93'
-        self._ansi_csi_regex = re.compile(self._ansi_csi_regex_str)
-        self._carriage_return = re.compile(self._carriage_return_str)
-        self._newline_regex = re.compile(self._newline_regex_str)
-        self._cursor_regex = re.compile(self._cursor_regex_str)
-        self._cursor_w_newline_regex = re.compile(self._cursor_w_newline_regex_str)
-        self._clear_regex = re.compile(self._clear_regex_str)
-        self._endash_regex = re.compile(self._endash_regex_str)
-        self._ansi_escape_8bit_regex = ANSI_ESCAPE_8BIT_REGEX
-        self._ansi_escape_allowcolor_regex = ANSI_ESCAPE_ALLOWCOLOR_REGEX
-        self._ansi_escape_regex = self._ansi_escape_allowcolor_regex if self._is_ansi_allow_color else self._ansi_escape_8bit_regex
+        self._tokenizer = AnsiTokenizer()
         self._ansi_color = AnsiColor()
+        self._screen = AnsiScreen(self.rv, terminal_height)
         if is_ansi_allow_color:
             self._ansi_sublime_regions = AnsiSublimeRegions(self.rv)
         self._debug = False
@@ -43,242 +29,206 @@ class AnsiControl:
         pos = self.rv._output_end - self.rv._prompt_size
         return pos
 
-    def _find_line_start(self, view_text):
+    def _find_line_start(self):
         """returns \n pos+1"""
-        text = view_text[:self._cursor_pos]
-        m = re.search(self._newline_regex, text[::-1])
-        if not m:
-            pos = 0
-            return False, pos
-        start = m.start()
-        pos = len(text) - start
-        return True, pos
+        return self._screen.line_start(self._cursor_pos)
 
-    def _find_line_end(self, view_text):
+    def _find_line_end(self):
         """returns \n pos"""
-        text = view_text[self._cursor_pos:]
-        m = re.search(self._newline_regex, text)
-        if not m:
-            pos = self._get_text_end()
-            return False, pos
-        start = m.start()
-        pos = self._cursor_pos + start
-        return True, pos
+        return self._screen.line_end(self._cursor_pos)
 
     def _check_cursor_moved(self):
         ret = self._cursor_pos != self._get_text_end()
         return ret
 
-    def _move_line_up(self, view_text, num_move):
-        offset = None
+    def _move_line_up(self, num_move):
         if self._limit_cursor_up:
             text_end = self._get_text_end()
-            n_lines = view_text[self._cursor_pos:text_end+1].count('\n') + 1
+            n_lines = self._screen.count_newlines(self._cursor_pos, text_end) + 1
             max_move = self._terminal_height - n_lines
             num_move = min(num_move, max_move)
             if num_move < 1:
                 return
-        for _ in range(num_move):
-            ret, pos = self._find_line_start(view_text)
-            if not ret:
-                return
-            if offset is None:
-                offset = self._cursor_pos - pos
-            self._cursor_pos = pos - 1
-            ret, pos = self._find_line_start(view_text)
-            self._cursor_pos = pos
-        ret, pos = self._find_line_end(view_text)
+        ret, pos = self._find_line_start()
+        offset = self._cursor_pos - pos
+        moved, pos = self._screen.lines_up(self._cursor_pos, num_move)
+        if not moved:
+            return
+        self._cursor_pos = pos
+        if moved < num_move:  # stopped at the first line
+            return
         self._insert_space_to_offset(offset)
 
-    def _move_line_down(self, view_text, num_move):
-        ret, pos = self._find_line_start(view_text)
+    def _move_line_down(self, num_move):
+        ret, pos = self._find_line_start()
         offset = self._cursor_pos - pos
-        for _ in range(num_move):
-            ret, pos = self._find_line_end(view_text)
-            if not ret:
-                self._cursor_pos = pos
-                self.insert('\n')
-                # pos = self._cursor_pos
-                continue
-            self._cursor_pos = pos + 1
+        moved, self._cursor_pos = self._screen.lines_down(self._cursor_pos, num_move)
+        if moved < num_move:
+            ret, self._cursor_pos = self._find_line_end()
+            self.insert('\n' * (num_move - moved))
         self._insert_space_to_offset(offset)
 
-    def _move_cursor_forward(self, view_text, num_move):
-        ret, pos = self._find_line_end(view_text)
+    def _move_cursor_forward(self, num_move):
+        ret, pos = self._find_line_end()
         new_pos = self._cursor_pos+num_move
         diff = pos-new_pos
         if diff < 0:
             self._cursor_pos = pos
-            text = ' '*diff
+            text = ' '*-diff
             self._insert_overwrite(text)
         else:
             self._cursor_pos = new_pos
 
-    def _move_cursor_backward(self, view_text, num_move):
+    def _move_cursor_backward(self, num_move):
         """
         CORRECT BEHAVIOUR IS WRAP AROUND
         self._cursor_pos -= num_move
         BUT DUE TO HTOP GOING BACK TOO MANY CHARS, LIMIT TO LINE START
         """
-        ret, pos = self._find_line_start(view_text)
+        ret, pos = self._find_line_start()
         new_pos = self._cursor_pos-num_move
         new_pos = max(pos, new_pos)
         self._cursor_pos = new_pos
 
-    def _move_cursor_coordinate(self, view_text, code):
+    def _move_cursor_coordinate(self, code):
+        """1-indexed row;col relative to the top of the screen"""
         code_split = code.split(';')
-        if len(code_split) == 1:
-            y = 0
-            x = 0
-        else:
-            y,x = code_split
-            if y == '':
-                y = 0
-            if x == '':
-                x = 0
-            y = int(y)
-            x = int(x)
-        self._cursor_pos = 0
-        if y:
-            self._move_line_down(view_text, y)
-        if x:
-            self._move_cursor_forward(view_text, x)
-
-    def _process_prefix(self, text, m):
-        start, end = m.span()
-        prefix = text[:start]
-        if len(prefix):
-            self.insert(prefix)
-        remaining = text[end:]
-        return remaining
-
-    @staticmethod
-    def _check_newline(m):
-        ret = m[0] == '\n'
-        return ret
+        y = code_split[0]
+        x = code_split[1] if len(code_split) > 1 else ''
+        y = int(y) if y else 1
+        x = int(x) if x else 1
+        self._cursor_pos = self._screen.screen_top()
+        if y > 1:
+            self._move_line_down(y - 1)
+        if x > 1:
+            self._move_cursor_forward(x - 1)
 
     def _process_newline(self):
         self._process_carriage_return()
-        self._move_line_down(self.rv.get_view_text(), 1)
-
-    @staticmethod
-    def _check_carriage_return(m):
-        ret = m[0] == '\r'
-        return ret
+        self._move_line_down(1)
 
     def _process_carriage_return(self):
-        view_text = self.rv.get_view_text()
-        text = view_text[:self._cursor_pos + 1]
-        ret, pos = self._find_line_start(text)
+        ret, pos = self._find_line_start()
         self._cursor_pos = pos
         return ret
 
     @staticmethod
-    def _check_cursor_move(m):
-        ret = m[2] in ('A', 'B', 'C', 'D', 'H')
+    def _check_cursor_move(params, final):
+        ret = final in ('A', 'B', 'C', 'D', 'H')
         return ret
 
-    def _process_cursor_move(self, m):
-        view_text = self.rv.get_view_text()
-        if m[2] == 'H':  # COORDINATE
-            self._move_cursor_coordinate(view_text, m[1])
+    def _process_cursor_move(self, params, final):
+        if final == 'H':  # COORDINATE
+            self._move_cursor_coordinate(params)
         else:
-            num_move = int(m[1]) if len(m[1]) else 1
-            if m[2] == 'A':  # UP
-                self._move_line_up(view_text, num_move)
-            elif m[2] == 'B':  # DOWN
-                self._move_line_down(view_text, num_move)
-            elif m[2] == 'C':  # FORWARD
-                self._move_cursor_forward(view_text, num_move)
-            elif m[2] == 'D':  # BACKWARD
-                self._move_cursor_backward(view_text, num_move)
+            num_move = int(params) if len(params) else 1
+            if final == 'A':  # UP
+                self._move_line_up(num_move)
+            elif final == 'B':  # DOWN
+                self._move_line_down(num_move)
+            elif final == 'C':  # FORWARD
+                self._move_cursor_forward(num_move)
+            elif final == 'D':  # BACKWARD
+                self._move_cursor_backward(num_move)
 
     @staticmethod
-    def _check_line_erase(m):
-        ret = m[1] in ('','0','1','2') and m[2] == 'K'
+    def _check_line_erase(params, final):
+        ret = params in ('','0','1','2') and final == 'K'
         return ret
 
-    def _process_line_erase(self, m):
-        view_text = self.rv.get_view_text()
-        if m[1] == '1':  # Start of line through cursor
-            _, start = self._find_line_start(view_text)
+    def _process_line_erase(self, params):
+        if params == '1':  # Start of line through cursor
+            _, start = self._find_line_start()
             end = self._cursor_pos
-        elif m[1] == '2':  # Start to end of line
-            _, start = self._find_line_start(view_text)
-            _, end = self._find_line_end(view_text)
+        elif params == '2':  # Start to end of line
+            _, start = self._find_line_start()
+            _, end = self._find_line_end()
         else:  # ('','0') Cursor to end of line
             start = self._cursor_pos
-            _, end = self._find_line_end(view_text)
+            _, end = self._find_line_end()
         self._erase(start, end)
 
     @staticmethod
-    def _check_display_erase(m):
-        ret = m[1] in ('','0','1','2','3') and m[2] == 'J'
+    def _check_display_erase(params, final):
+        ret = params in ('','0','1','2','3') and final == 'J'
         return ret
 
-    def _process_display_erase(self, m):
-        if m[1] == '1':  # Start of display through cursor
+    def _process_display_erase(self, params):
+        if params == '1':  # Start of display through cursor
             start = 0
             end = self._cursor_pos
-        elif m[1] in ('2','3'):  # entire display
+        elif params in ('2','3'):  # entire display
             start = 0
-            end = self.rv._view.size()
+            end = self._screen.view_size()
         else:  # ('','0') Cursor to end of display
             start = self._cursor_pos
-            end = self.rv._view.size()
+            end = self._screen.view_size()
         self._erase(start, end)
 
     @staticmethod
-    def _check_bracketed_paste(m):
-        ret = m[1] in ('?2004') and m[2] in ('h','l')
+    def _check_bracketed_paste(params, final):
+        ret = params == '?2004' and final in ('h','l')
         return ret
 
-    def _process_bracketed_paste(self, m):
-        if m[1] == 'h':  # Enable bracketed paste
+    def _process_bracketed_paste(self, final):
+        if final == 'h':  # Enable bracketed paste
             pass
-        elif m[1] == 'l':  # Disable bracketed paste
+        elif final == 'l':  # Disable bracketed paste
             pass
 
-    def _process_ansi(self, m):
-        if self._check_newline(m):
-            self._process_newline()
-        elif self._check_carriage_return(m):
-            self._process_carriage_return()
-        elif self._check_cursor_move(m):
-            self._process_cursor_move(m)
-        elif self._check_line_erase(m):
-            self._process_line_erase(m)
-        elif self._check_display_erase(m):
-            self._process_display_erase(m)
-        elif self._check_bracketed_paste(m):
-            self._process_bracketed_paste(m)
+    def _process_csi(self, params, final):
+        if self._check_cursor_move(params, final):
+            self._process_cursor_move(params, final)
+        elif self._check_line_erase(params, final):
+            self._process_line_erase(params)
+        elif self._check_display_erase(params, final):
+            self._process_display_erase(params)
+        elif self._check_bracketed_paste(params, final):
+            self._process_bracketed_paste(final)
 
     def _erase(self, start, end):
         length = end - start
         if length <= 0:
             return
-        self.rv._output_end -= length
-        self.rv._view.run_command("repl_erase_text", {"start": start, "end": end})
+        # only the part before _output_end is repl output, the rest is user input
+        self.rv._output_end -= max(0, min(end, self.rv._output_end) - start)
+        # text after the erased range shifts left, keep the cursor on it
+        if self._cursor_pos >= end:
+            self._cursor_pos -= length
+        elif self._cursor_pos > start:
+            self._cursor_pos = start
+        self._screen.erase(start, end)
+        if self._is_ansi_allow_color:
+            self._ansi_sublime_regions.erase(start, end)
+
+    def view_erased(self, start, end):
+        """keeps the cursor and colours in step with text erased from the
+           view outside the controller (clear, scrollback trimming)"""
+        if self._cursor_pos >= end:
+            self._cursor_pos -= end - start
+        elif self._cursor_pos > start:
+            self._cursor_pos = start
+        if self._is_ansi_allow_color:
+            self._ansi_sublime_regions.erase(start, end)
+            self._ansi_sublime_regions.flush()
 
     def _insert_append(self, text, pos, style=None):
         self.rv._output_end += len(text)
         self._cursor_pos += len(text)
-        self.rv._view.run_command("repl_insert_text", {"pos": pos, "text": text})
-        if self._is_ansi_allow_color and style is not None:
-            self._ansi_sublime_regions.insert_append(pos, self._cursor_pos, style)
+        self._screen.insert(pos, text)
+        if self._is_ansi_allow_color:
+            self._ansi_sublime_regions.insert(pos, pos + len(text), style)
 
-    def _insert_overwrite(self, text):
-        view_text = self.rv.get_view_text()
-        ret, pos = self._find_line_end(view_text)
+    def _insert_overwrite(self, text, style=None):
+        ret, pos = self._find_line_end()
         line_length = pos - self._cursor_pos
         overwrite_length = min(line_length,len(text))
         end = self._cursor_pos + overwrite_length
         self._erase(self._cursor_pos, end)
-        self._insert_append(text, self._cursor_pos)
+        self._insert_append(text, self._cursor_pos, style)
 
     def _insert_space_to_offset(self, offset):
-        view_text = self.rv.get_view_text()
-        ret, pos = self._find_line_end(view_text)
+        ret, pos = self._find_line_end()
         if self._cursor_pos + offset > pos:
             n_spaces = self._cursor_pos + offset - pos
             self._cursor_pos = pos
@@ -287,25 +237,21 @@ class AnsiControl:
             self._cursor_pos += offset
 
     def _insert(self, text, style=None):
-        text = self._ansi_escape_regex.sub('', text)
         if self._debug and self._debug_file_handle:
             self._debug_file_handle.write(text)
         is_cursor_moved = self._check_cursor_moved()
         if is_cursor_moved:
-            self._insert_overwrite(text)
+            self._insert_overwrite(text, style)
             return
         self._insert_append(text, self._cursor_pos, style)
 
     def insert(self, text):
+        """inserts text at the cursor in the current colour"""
         if self._is_ansi_allow_color:
-            ret, text_sections = self._ansi_color.run(text)
-            for text_section in text_sections:
-                txt, style = text_section
-                self._insert(txt, style)
+            self._insert(text, self._ansi_color.style)
         else:
             self._insert(text)
 
-
     def run(self, text, debug=False):
         # print('ansicontrol text')
         # print(text)
@@ -320,21 +266,25 @@ class AnsiControl:
             self._debug_file_handle.write(text)
             self._debug_file_handle.write("\n-----output-----\n")
 
-        _text = text
-        _text = self._clear_regex.sub('\x1b[J', _text)
-        _text = self._endash_regex.sub('-', _text)
-        while True:
-            if not len(_text):
-                break
-            regex = self._cursor_w_newline_regex if self._check_cursor_moved() else self._cursor_regex
-            m = re.search(regex, _text)
-            if m is None:
-                break
-            _text = self._process_prefix(_text, m)
-            self._process_ansi(m)
-        if len(_text):
-            self.insert(_text)
+        self._screen.sync(self._cursor_pos)
+        for kind, value, final in self._tokenizer.feed(text):
+            if kind == TEXT:
+                self.insert(value)
+            elif kind == LF:
+                # newlines are plain text unless the cursor was moved back
+                if self._check_cursor_moved():
+                    self._process_newline()
+                else:
+                    self.insert(value)
+            elif kind == CR:
+                self._process_carriage_return()
+            elif kind == CSI:
+                self._process_csi(value, final)
+            elif kind == SGR and self._is_ansi_allow_color:
+                self._ansi_color.apply_sgr(value)
+        self._screen.flush()
         if self._is_ansi_allow_color:
+            self._ansi_sublime_regions.flush()
             self._ansi_sublime_regions.update_color_scheme()
 
         if self._debug_file_handle:
@@ -354,22 +304,60 @@ def main():
     class MockView:
         def __init__(self, text=""):
             self._text = text
+            self._regions = {}
+        def add_regions(self, key, regions):
+            self._regions[key] = [list(region) for region in regions]
+        def erase_regions(self, key):
+            self._regions.pop(key, None)
+        def _move_regions(self, start, end, n):
+            # what sublime does to regions when [start, end) is replaced by n chars
+            for regions in self._regions.values():
+                for region in regions:
+                    for i in (0, 1):
+                        # text inserted at the end of a region stays outside it
+                        if region[i] > end or region[i] == end and (start < end or i == 0):
+                            region[i] += n - (end - start)
+                        elif region[i] > start:
+                            region[i] = start
         def size(self):
             size = len(self._text)
             return size
+        def rowcol(self, pos):
+            pos = min(pos, len(self._text))
+            row = self._text.count('\n', 0, pos)
+            col = pos - (self._text.rfind('\n', 0, pos) + 1)
+            return row, col
+        def text_point(self, row, col):
+            pos = 0
+            for _ in range(row):
+                i = self._text.find('\n', pos)
+                if i < 0:
+                    return len(self._text)
+                pos = i + 1
+            return pos + col
         def _erase_text(self, args):
             start = args["start"]
             end = args["end"]
             self._text = self._text[:start]+self._text[end:]
+            self._move_regions(start, end, 0)
         def _insert_text(self, args):
             pos = args["pos"]
             text = args["text"]
             self._text = self._text[:pos]+text+self._text[pos:]
+            self._move_regions(pos, pos, len(text))
+        def _replace_text(self, args):
+            start = args["start"]
+            end = args["end"]
+            text = args["text"]
+            self._text = self._text[:start]+text+self._text[end:]
+            self._move_regions(start, end, len(text))
         def run_command(self, command, args):
             if command == 'repl_erase_text':
                 self._erase_text(args)
             elif command == 'repl_insert_text':
                 self._insert_text(args)
+            elif command == 'repl_replace_text':
+                self._replace_text(args)
             else:
                 raise NotImplementedError(f'{command} {args}')
     class MockReplView:
@@ -377,8 +365,10 @@ def main():
             self._view = view
             self._prompt_size = 0
             self._output_end = self._view.size()
-        def get_view_text(self):
-            text = self._view._text
+        def get_view_text(self, start=0, end=None):
+            if end is None:
+                end = self._view.size()
+            text = self._view._text[start:end]
             return text
     view_text = ''
     view = MockView(view_text)
@@ -388,6 +378,110 @@ def main():
     text = '\x1b[m\x0f3\x1b[0;1m\x0f[\x1b[0m\x0f                          0.0%\x1b[0;1m\x0f]\x1b[1B'
     handler.run(text)
     print(rv.get_view_text())
+
+    def render(text, chunks, terminal_height=24, limit_cursor_up=False):
+        view = MockView(text)
+        rv = MockReplView(view)
+        handler = AnsiControl(rv=rv, terminal_height=terminal_height, limit_cursor_up=limit_cursor_up)
+        handler._cursor_pos = view.size()
+        for chunk in chunks:
+            handler.run(chunk)
+            screen = handler._screen
+            assert screen._starts == [0] + _line_starts(screen._text), 'line index out of sync'
+            assert screen._text == view._text[screen._base:rv._output_end], 'screen out of sync'
+        return view._text, handler._cursor_pos
+
+    # vertical motion keeps the column, padding short lines
+    assert render('aaaa\nbb\ncccc', ['\x1b[2DX\x1b[AY\x1b[AZ']) == ('aaaaZ\nbb Y\nccXc', 5)
+    # moving up past the first line stops there, text is overwritten
+    assert render('a\nb\nc', ['\x1b[10AX']) == ('X\nb\nc', 1)
+    # moving down past the last line appends lines
+    assert render('ab', ['\x1b[D\x1b[2BX']) == ('ab\n\n X', 6)
+    # limit_cursor_up stops at the top of the terminal
+    assert render('1\n2\n3\n4\n5', ['\x1b[10AX'], terminal_height=3, limit_cursor_up=True) == ('1\n2\n3X\n4\n5', 6)
+    # cursor position is relative to the top of the screen
+    assert render('old\n1\n2\n3', ['\x1b[2;2HX'], terminal_height=3) == ('old\n1\n2X\n3', 8)
+    # erase line and carriage return
+    assert render('', ['12345\r\x1b[2C\x1b[KX\nnext']) == ('12X\nnext', 8)
+    # lines above the screen are read from the view on demand
+    history = ''.join(f'line {i}\n' for i in range(100))
+    assert render(history, ['\x1b[60AX'], terminal_height=5)[0] == history.replace('line 40', 'Xine 40')
+
+    # a recorded session: coloured prompt, ls --color, a progress bar redrawn
+    # with \r and erase line, a status line redrawn with cursor up, and mode
+    # and charset escapes. Splitting it at every offset must render the same.
+    session = ('\x1b[?2004h\x1b[01;32muser@host\x1b[00m:\x1b[01;34m~\x1b[00m$ ls\r\n'
+               '\x1b[?2004l\r\x1b[0m\x1b[01;34mbin\x1b[0m  \x1b[38;5;208mlog.txt\x1b[0m  \x1b[01;32mrun.sh\x1b[0m\r\n'
+               + ''.join(f'\r\x1b[K[{"#" * i}{" " * (10 - i)}] {i * 10}%' for i in range(11))
+               + '\r\n\x1b(B\x1b[m\x1b[1mstatus\x1b[0;1m\x0f ok\x1b[m\x0f\r\n\x1b[2A\x1b[4C\x1b[K: done\x1b[1B\r'
+               '\x1b[31;42mcolour\x1b[38;2;255;95;0mtruecolour\x1b[39;49m\x1b[3D\x1b[1K\x1b[?2004h$ ')
+
+    class MockRegions:
+        # AnsiSublimeRegions without sublime
+        def __init__(self, view):
+            self._view = view
+            self._spans = AnsiSpans()
+        def insert(self, start, end, style=None):
+            scope = None if style is None else style.scope
+            self._spans.insert(start, end, scope)
+        def erase(self, start, end):
+            self._spans.erase(start, end)
+        def flush(self):
+            for scope in self._spans.pop_dirty():
+                regions = self._spans.spans(scope)
+                if regions:
+                    self._view.add_regions(scope, regions)
+                else:
+                    self._view.erase_regions(scope)
+        def update_color_scheme(self):
+            pass
+
+    def render_colour(chunks):
+        view = MockView('')
+        rv = MockReplView(view)
+        handler = AnsiControl(rv=rv)
+        handler._is_ansi_allow_color = True
+        handler._ansi_sublime_regions = MockRegions(view)
+        for chunk in chunks:
+            handler.run(chunk)
+            spans = handler._ansi_sublime_regions._spans
+            # regions sublime moved itself agree with the ones re-added
+            for scope, regions in view._regions.items():
+                assert regions == [list(span) for span in spans.spans(scope)], f'{scope} out of sync'
+        regions = sorted((scope, tuple(map(tuple, regions))) for scope, regions in view._regions.items())
+        return view._text, handler._cursor_pos, regions
+
+    try:
+        from .ansi_regex import ANSI_ESCAPE_8BIT_REGEX, ANSI_COLOR_REGEX
+        from .ansi_tokenizer import split_incomplete_escape
+    except ImportError:
+        from ansi_regex import ANSI_ESCAPE_8BIT_REGEX, ANSI_COLOR_REGEX
+        from ansi_tokenizer import split_incomplete_escape
+
+    def render_filtered(chunks):
+        # ReplView.write without emulate_ansi_csi
+        text = tail = ''
+        for chunk in chunks:
+            chunk = tail + chunk
+            end = split_incomplete_escape(chunk)
+            chunk, tail = chunk[:end], chunk[end:]
+            text += ANSI_COLOR_REGEX.sub('', ANSI_ESCAPE_8BIT_REGEX.sub('', chunk))
+        return text
+
+    # overwritten colours are cut back, adjacent ones merged
+    text, _, regions = render_colour(['\x1b[31mabc\x1b[0m\rx\x1b[31mb\x1b[0m\x1b[1Cd'])
+    assert text == 'xbcd' and regions == [('#cd0000None', ((1, 3),))], regions
+
+    expected = render('', [session]), render_colour([session]), render_filtered([session])
+    for i in range(len(session) + 1):
+        chunks = [session[:i], session[i:]]
+        assert render('', chunks) == expected[0], f'split at {i}'
+        assert render_colour(chunks) == expected[1], f'colour split at {i}'
+        assert render_filtered(chunks) == expected[2], f'filter split at {i}'
+    # and one character per read
+    chunks = list(session)
+    assert (render('', chunks), render_colour(chunks), render_filtered(chunks)) == expected
+    print('ok')
     return
 if __name__ == '__main__':
     main()
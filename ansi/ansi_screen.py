@@ -0,0 +1,197 @@
+from bisect import bisect_left, bisect_right
+
+
+def _line_starts(text, offset=0):
+    """offsets (+offset) of every position following a \\n in text"""
+    starts = []
+    i = text.find('\n')
+    while i >= 0:
+        starts.append(offset + i + 1)
+        i = text.find('\n', i + 1)
+    return starts
+
+
+class AnsiScreen:
+    """In-memory copy of the end of a repl view.
+
+    Holds the view text from the top of the terminal screen (or the line of
+    the cursor, if it sits above it) to the end of repl output, so cursor
+    navigation never has to copy the whole view out of sublime.
+    A sorted index of line starts is kept up to date on every edit, so line
+    lookups and vertical cursor motion are a bisect instead of a scan.
+    Edits are applied here first and forwarded to the view coalesced into as
+    few repl_replace_text commands as possible.
+    Positions are absolute view offsets, like AnsiControl._cursor_pos."""
+
+    def __init__(self, rv, terminal_height=24):
+        self.rv = rv
+        self._terminal_height = terminal_height
+        self._base = 0  # view offset of self._text[0], always a line start
+        self._text = ''
+        self._starts = [0]  # line starts relative to _base
+        self._pending = None  # [start, end, text] replace not yet sent to the view
+
+    @property
+    def end(self):
+        return self._base + len(self._text)
+
+    def _text_end(self):
+        return self.rv._output_end - self.rv._prompt_size
+
+    def _view_line_start(self, pos, rows_up=0):
+        view = self.rv._view
+        row, _ = view.rowcol(pos)
+        return view.text_point(max(0, row - rows_up), 0)
+
+    def _reindex(self):
+        self._starts = [0] + _line_starts(self._text)
+
+    def sync(self, cursor_pos):
+        """Re-reads the screen from the view, which may have been edited
+           outside AnsiControl (clear, echoed input, scrollback trimming)"""
+        self.flush()
+        text_end = self._text_end()
+        base = self._view_line_start(text_end, self._terminal_height - 1)
+        cursor_pos = min(cursor_pos, text_end)
+        if cursor_pos < base:
+            base = self._view_line_start(cursor_pos)
+        self._base = base
+        self._text = self.rv.get_view_text(base, text_end)
+        self._reindex()
+
+    def _extend(self, pos, rows_up=None):
+        """Prepends lines from the view so that pos, and rows_up lines above
+           it (a screenful by default), are covered.
+           Text before the screen is never touched by pending edits."""
+        if rows_up is None:
+            rows_up = self._terminal_height - 1
+        base = self._view_line_start(min(pos, self._base), rows_up)
+        if base >= self._base:
+            return
+        prefix = self.rv.get_view_text(base, self._base)
+        n = len(prefix)
+        self._text = prefix + self._text
+        self._starts = [0] + _line_starts(prefix) + [s + n for s in self._starts[1:]]
+        self._base = base
+
+    def _line_index(self, pos):
+        """index in _starts of the line holding pos"""
+        if pos < self._base:
+            self._extend(pos)
+        return bisect_right(self._starts, pos - self._base) - 1
+
+    def line_start(self, pos):
+        """returns (True, \\n pos+1) or (False, 0) when pos is on the first line"""
+        start = self._starts[self._line_index(pos)]
+        if start or self._base:
+            return True, self._base + start
+        return False, 0
+
+    def line_end(self, pos):
+        """returns (True, \\n pos) or (False, end of output)"""
+        k = self._line_index(pos) + 1
+        if k < len(self._starts):
+            return True, self._base + self._starts[k] - 1
+        return False, self.end
+
+    def lines_up(self, pos, num_move):
+        """returns how many lines above pos exist (up to num_move) and the
+           start of the line that many lines up"""
+        k = self._line_index(pos)
+        while k < num_move and self._base:
+            self._extend(self._base, num_move - k)
+            k = self._line_index(pos)
+        moved = min(k, num_move)
+        return moved, self._base + self._starts[k - moved]
+
+    def lines_down(self, pos, num_move):
+        """returns how many lines below pos exist (up to num_move) and the
+           start of the line that many lines down"""
+        k = self._line_index(pos)
+        moved = min(len(self._starts) - 1 - k, num_move)
+        return moved, self._base + self._starts[k + moved]
+
+    def count_newlines(self, start, end):
+        if start < self._base:
+            self._extend(start)
+        start -= self._base
+        end -= self._base
+        return bisect_left(self._starts, end + 1) - bisect_left(self._starts, start + 1)
+
+    def screen_top(self):
+        """start of the first of the last terminal_height lines of output"""
+        _, pos = self.lines_up(self.end, self._terminal_height - 1)
+        return pos
+
+    def view_size(self):
+        size = self.rv._view.size()
+        if self._pending is not None:
+            start, end, text = self._pending
+            size += len(text) - (end - start)
+        return size
+
+    def _index_insert(self, i, text):
+        k = bisect_right(self._starts, i)
+        n = len(text)
+        self._starts[k:] = _line_starts(text, i) + [s + n for s in self._starts[k:]]
+
+    def _index_erase(self, i, j):
+        k1 = bisect_right(self._starts, i)
+        k2 = bisect_right(self._starts, j)
+        n = j - i
+        self._starts[k1:] = [s - n for s in self._starts[k2:]]
+
+    def insert(self, pos, text):
+        if not text:
+            return
+        if pos < self._base:
+            self._extend(pos)
+        pos = min(pos, self.end)
+        i = pos - self._base
+        self._text = self._text[:i] + text + self._text[i:]
+        self._index_insert(i, text)
+        if self._pending is not None:
+            start, end, pending_text = self._pending
+            if start <= pos <= start + len(pending_text):
+                i = pos - start
+                self._pending[2] = pending_text[:i] + text + pending_text[i:]
+                return
+            self.flush()
+        self._pending = [pos, pos, text]
+
+    def erase(self, start, end):
+        if end <= start:
+            return
+        i = max(start, self._base) - self._base
+        j = min(max(end, self._base) - self._base, len(self._text))
+        if i < j:
+            self._text = self._text[:i] + self._text[j:]
+            self._index_erase(i, j)
+        if start < self._base:
+            # only erase display reaches above the screen, send it straight away
+            self.flush()
+            self.rv._view.run_command("repl_erase_text", {"start": start, "end": end})
+            self._base = start
+            self._reindex()
+            if start > 0:
+                self._extend(start)
+            return
+        if self._pending is not None:
+            p_start, p_end, p_text = self._pending
+            p_text_end = p_start + len(p_text)
+            if start == p_text_end:
+                self._pending[1] = p_end + end - start
+                return
+            if p_start <= start and end <= p_text_end:
+                self._pending[2] = p_text[:start - p_start] + p_text[end - p_start:]
+                return
+            self.flush()
+        self._pending = [start, end, '']
+
+    def flush(self):
+        """sends the pending edit to the view"""
+        if self._pending is None:
+            return
+        start, end, text = self._pending
+        self._pending = None
+        self.rv._view.run_command("repl_replace_text", {"start": start, "end": end, "text": text})
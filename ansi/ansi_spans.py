@@ -0,0 +1,103 @@
+from bisect import bisect_left, bisect_right
+
+
+class AnsiSpans:
+    """Coloured spans of a repl view, grouped by scope.
+
+    Each scope keeps its spans as sorted begin and end lists that never
+    overlap. Spans move with every insert and erase, so after a batch of
+    edits only the scopes that changed beyond a plain shift (which sublime
+    does to its regions itself) need to be re-added to the view.
+    Adjacent spans of the same scope are merged."""
+
+    def __init__(self):
+        self._begins = {}  # scope: [begin, ...]
+        self._ends = {}  # scope: [end, ...]
+        self._dirty = set()
+
+    def spans(self, scope):
+        return list(zip(self._begins.get(scope, ()), self._ends.get(scope, ())))
+
+    def pop_dirty(self):
+        """returns the scopes changed since the last call"""
+        dirty = self._dirty
+        self._dirty = set()
+        return dirty
+
+    def insert(self, start, end, scope=None):
+        """text [start, end) was inserted, coloured as scope if given"""
+        n = end - start
+        if n <= 0:
+            return
+        for s, begins in self._begins.items():
+            ends = self._ends[s]
+            k = bisect_right(ends, start)
+            if k == len(ends):
+                continue
+            if begins[k] < start:
+                # text inserted inside a span, split it around the text
+                begins.insert(k + 1, start)
+                ends.insert(k + 1, ends[k])
+                ends[k] = start
+                k += 1
+                self._dirty.add(s)
+            elif begins[k] == start:
+                # sublime may grow a region at its start, re-add it
+                self._dirty.add(s)
+            begins[k:] = [b + n for b in begins[k:]]
+            ends[k:] = [e + n for e in ends[k:]]
+        if scope is None:
+            return
+        begins = self._begins.setdefault(scope, [])
+        ends = self._ends.setdefault(scope, [])
+        k = bisect_right(ends, start)
+        left = k > 0 and ends[k - 1] == start
+        right = k < len(begins) and begins[k] == end
+        if left and right:
+            ends[k - 1] = ends[k]
+            del begins[k]
+            del ends[k]
+        elif left:
+            ends[k - 1] = end
+        elif right:
+            begins[k] = start
+        else:
+            begins.insert(k, start)
+            ends.insert(k, end)
+        self._dirty.add(scope)
+
+    def erase(self, start, end):
+        """text [start, end) was erased"""
+        n = end - start
+        if n <= 0:
+            return
+        for s, begins in self._begins.items():
+            ends = self._ends[s]
+            k = bisect_right(ends, start)  # spans before k end before the erase
+            j = bisect_left(begins, end)  # spans from j begin after it
+            if k == len(ends):
+                continue
+            new_begins = []
+            new_ends = []
+            if k < j:
+                # what is left of spans overlapping the erased text
+                head = begins[k] if begins[k] < start else start
+                tail = ends[j - 1] - n if ends[j - 1] > end else start
+                if tail > head:
+                    new_begins.append(head)
+                    new_ends.append(tail)
+                self._dirty.add(s)
+            begins[k:] = new_begins + [b - n for b in begins[j:]]
+            ends[k:] = new_ends + [e - n for e in ends[j:]]
+            # spans on both sides of the erased text may now touch
+            i = bisect_left(ends, start)
+            if i + 1 < len(ends) and ends[i] == start and begins[i + 1] == start:
+                ends[i] = ends[i + 1]
+                del begins[i + 1]
+                del ends[i + 1]
+                self._dirty.add(s)
+
+    def clear(self):
+        self._dirty.update(self._begins)
+        self._begins = {}
+        self._ends = {}
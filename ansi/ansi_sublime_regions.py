@@ -1,6 +1,9 @@
 import sublime
 
-import json
+try:
+    from .ansi_spans import AnsiSpans
+except ImportError:
+    from ansi_spans import AnsiSpans
 
 
 class AnsiSublimeRegions:
@@ -8,43 +11,40 @@ class AnsiSublimeRegions:
         self.rv = rv
         self._styles = {}
         self._scopes_to_add = []
+        self._spans = AnsiSpans()
 
     def _erase_scope(self, scope):
         self.rv._view.erase_regions(scope)
 
-    def insert_append(self, start, end, style):
-        scope = f"{style['fg']}{style['bg']}"
-        if scope not in self._styles:
-            self._styles[scope] = style
-            self._scopes_to_add.append(scope)
-        region = sublime.Region(start,end)
-        sum_regions = self.rv._view.get_regions(scope) + [region]
-        self.rv._view.add_regions(
-            scope, sum_regions, scope, "", sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT
-        )
+    def insert(self, start, end, style=None):
+        """text [start, end) was inserted, in colour if style is given"""
+        scope = None
+        if style is not None:
+            scope = style.scope
+            if scope not in self._styles:
+                self._styles[scope] = style
+                self._scopes_to_add.append(scope)
+        self._spans.insert(start, end, scope)
+
+    def erase(self, start, end):
+        self._spans.erase(start, end)
+
+    def clear(self):
+        self._spans.clear()
+
+    def flush(self):
+        """re-adds the regions of every scope changed since the last flush"""
+        for scope in self._spans.pop_dirty():
+            regions = [sublime.Region(a, b) for a, b in self._spans.spans(scope)]
+            if not regions:
+                self._erase_scope(scope)
+                continue
+            self.rv._view.add_regions(
+                scope, regions, scope, "", sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT
+            )
 
     def update_color_scheme(self):
         if not len(self._scopes_to_add):
             return
-        with open(self.rv._cs_file, 'r') as f:
-            color_scheme = json.load(f)
-        for scope in self._scopes_to_add:
-            style = self._styles[scope]
-            style_dict = {'scope': scope}
-            if style['fg']:
-                style_dict['foreground'] = style['fg']
-            if style['bg']:
-                bg = style['bg']
-            else:
-                background = color_scheme['globals']['background']
-                if background[-1].lower() == 'f':
-                    char = ord(background[-1])-1
-                else:
-                    char = ord(background[-1])+1
-                bg = f'{background[:-1]}{chr(char)}'
-            style_dict['background'] = bg
-            color_scheme['rules'].append(style_dict)
+        self.rv._cs_scheme.add_styles([(scope, self._styles[scope]) for scope in self._scopes_to_add])
         self._scopes_to_add = []
-        with open(self.rv._cs_file, 'w') as f:
-            json.dump(color_scheme, f)
-        self.rv._view.settings().set('color_scheme', self.rv._view.settings().get('color_scheme'))
@@ -0,0 +1,71 @@
+import re
+
+TEXT = 'text'
+SGR = 'sgr'  # select graphic rendition (colour), value is the parameter string
+CSI = 'csi'  # any other control sequence, value is the parameter string, final is the command letter
+CR = 'cr'
+LF = 'lf'
+
+ANSI_TOKEN_REGEX = re.compile(
+    r'(?P<sgr>\x1b\[(?P<sgr_params>[0-9;]*)m\x0f?)'
+    r'|(?P<csi>\x1b\[(?P<csi_params>\??\d*[;|\d*]*)(?P<csi_final>[a-ln-zA-Z]))'
+    r'|(?P<cr>\r)'
+    r'|(?P<lf>\n)'
+    r'|(?P<endash>\xe2\x80\x93)'
+    r'|(?P<strip>'
+    r'\x1b\[\]\w?|\x1b[()][0-9A-Za-z]'  # charset
+    r'|\x1b\[\??[\d;|*]*[a-zA-Z]'  # sequences not matched above, eg. private modes ending in m
+    r'|\x1b[0-Z\\-_a-z]'  # two character escapes
+    r'|[\x80-\x9a\x9c-\x9f]'  # 8 bit control characters
+    r'|[\x00\x0e\x0f]+'  # null, shift out/in
+    r')'
+)
+# an escape sequence cut off by the end of a packet
+ANSI_INCOMPLETE_REGEX = re.compile(r'\x1b(?:\[[\d;?|*]*|\[\]|[()])?')
+ANSI_INCOMPLETE_MAX_LENGTH = 32
+
+
+def split_incomplete_escape(text):
+    """returns the offset of an escape sequence cut off at the end of text,
+       or len(text) if text ends on a complete token"""
+    i = text.rfind('\x1b', max(0, len(text) - ANSI_INCOMPLETE_MAX_LENGTH))
+    if i >= 0 and ANSI_INCOMPLETE_REGEX.fullmatch(text, i):
+        return i
+    return len(text)
+
+
+class AnsiTokenizer:
+    """Splits repl output into (kind, value, final) tokens in a single pass.
+
+    TEXT tokens are slices between escape sequences, escapes that are not
+    interpreted are dropped. An escape sequence cut off at the end of a
+    packet is held back and prepended to the next one, so feed() can be
+    called with output exactly as it was read."""
+
+    def __init__(self):
+        self._tail = ''
+
+    def feed(self, text):
+        if self._tail:
+            text = self._tail + text
+        end = split_incomplete_escape(text)
+        self._tail = text[end:]
+        pos = 0
+        for m in ANSI_TOKEN_REGEX.finditer(text, 0, end):
+            start = m.start()
+            if start > pos:
+                yield TEXT, text[pos:start], None
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'sgr':
+                yield SGR, m.group('sgr_params'), None
+            elif kind == 'csi':
+                yield CSI, m.group('csi_params'), m.group('csi_final')
+            elif kind == 'cr':
+                yield CR, '\r', None
+            elif kind == 'lf':
+                yield LF, '\n', None
+            elif kind == 'endash':
+                yield TEXT, '-', None
+        if end > pos:
+            yield TEXT, text[pos:end], None
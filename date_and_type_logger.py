@@ -1,8 +1,14 @@
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import threading
 
-__version__ = "1.3.0"
+__version__ = "1.4.0"
+
+_listeners = {}  # logger name: _BatchQueueListener writing its records
+_listeners_lock = threading.Lock()
 
 
 class DataAndTypeLoggerAdapter(logging.LoggerAdapter):
@@ -15,66 +21,203 @@ class DataAndTypeLoggerAdapter(logging.LoggerAdapter):
         return msg, kwargs
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON, data is kept as a JSON value
+    and quotes or newlines in any field are escaped."""
+
+    def format(self, record):
+        entry = {
+            "asctime": self.formatTime(record),
+            "levelname": record.levelname,
+            "type": getattr(record, "type", ""),
+            "message": record.getMessage(),
+            "data": getattr(record, "data", None),
+            "name": record.name,
+            "funcName": record.funcName,
+            "lineno": record.lineno,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _BatchFlushMixin:
+    """Leaves the flush StreamHandler.emit does after every record to
+    flush_batch(), closing or rotating the file still flushes it."""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        logging.StreamHandler.flush(self)
+
+
+class _BatchStreamHandler(_BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class _BatchFileHandler(_BatchFlushMixin, logging.FileHandler):
+    pass
+
+
+class _BatchTimedRotatingFileHandler(_BatchFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+class _BatchQueueListener(logging.handlers.QueueListener):
+    """Writes queued records on its own thread, flushing the handlers once
+    the queue is drained instead of after every record."""
+
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush_batch()
+        return self.queue.get(block)
+
+
+def stop_date_and_type_loggers():
+    """writes out queued records and closes the files of every logger"""
+    with _listeners_lock:
+        listeners = list(_listeners.items())
+        _listeners.clear()
+    for name, listener in listeners:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        logging.getLogger(name).handlers = []
+
+
 def get_date_and_type_logger(name=__name__, default_type="", to_stdout=True, to_file=True,
                              timed_rotate_split_error=False, rotate_log=False, rotate_kwargs=None, log_directory_path=None,
                              filename=None, level_stdout=logging.DEBUG, level_file=logging.DEBUG):
     """
+    Records are handed to a queue and written by a background thread, so logging does not wait on the file.
+    Later calls with the same name reuse the handlers of the first one.
+
     :param name: name of logger to get
     :param default_type: name for context of log
     :param to_stdout: print logs to stdout
     :param to_file: save logs to file
     :param timed_rotate_split_error: save logs to file, creating extra file for error logs, and rotate the log files every hour (overwrites rotate_log)
-    :param rotate_log: if to_file,  rotate the log files (every hour by default) (overwritten by timed_rotate_split_error) 
+    :param rotate_log: if to_file,  rotate the log files (every hour by default) (overwritten by timed_rotate_split_error)
     :param rotate_kwargs: keyword arguments for TimedRotatingFileHandler
     :param log_directory_path: log directory
     :param filename: log file name (ignored if timed_rotate_split_error)
     :param level: logging level
     :returns: logger
     """
-    if rotate_kwargs is None:
-        rotate_kwargs = {}
-    logger_ = logging.getLogger(name)
-    level_stdout = logging._checkLevel(level_stdout)
-    level_file = logging._checkLevel(level_file)
-    level_logger = min(level_stdout, level_file)
-    logfmt = logging.Formatter("{" + ", ".join(f"\"{k}\": \"%({k})s\"" for k in (
-        "asctime", "levelname", "type", "message", "data", "name", "funcName")) + ", \"lineno\": \"%(lineno)d\"}")
-
-    log_handlers = []
-    log_levels = []
-    if to_stdout:
-        log_handlers.append(logging.StreamHandler())
-        log_levels.append(level_stdout)
-
-    if to_file:
-        if log_directory_path is None:
-            log_directory_path = ''
-        else:
-            os.makedirs(log_directory_path, exist_ok=True)
-        if timed_rotate_split_error:
-            error_log_path = os.path.join(log_directory_path, 'error_logs.json')
-            all_log_path = os.path.join(log_directory_path, 'daily_log.json')
-            log_handlers.append(logging.handlers.TimedRotatingFileHandler(error_log_path, **rotate_kwargs))
-            log_levels.append(logging.WARNING)
-            log_handlers.append(logging.handlers.TimedRotatingFileHandler(all_log_path, **rotate_kwargs))
-            log_levels.append(logging.DEBUG)
-            level_logger = min(level_logger, logging.DEBUG)
-        else:
-            if filename is None:
-                filename = f'{default_type}_log.json' if default_type else 'log.json'
-            log_path = os.path.join(log_directory_path, filename)
-            if rotate_log:
-                log_handler = logging.handlers.TimedRotatingFileHandler(log_path, **rotate_kwargs)
+    with _listeners_lock:
+        logger_ = logging.getLogger(name)
+        if name in _listeners:
+            return DataAndTypeLoggerAdapter(logger_, default_type=default_type)
+
+        if rotate_kwargs is None:
+            rotate_kwargs = {}
+        level_stdout = logging._checkLevel(level_stdout)
+        level_file = logging._checkLevel(level_file)
+        level_logger = min(level_stdout, level_file)
+        logfmt = JsonFormatter()
+
+        log_handlers = []
+        log_levels = []
+        if to_stdout:
+            log_handlers.append(_BatchStreamHandler())
+            log_levels.append(level_stdout)
+
+        if to_file:
+            if log_directory_path is None:
+                log_directory_path = ''
             else:
-                log_handler = logging.FileHandler(log_path)
-            log_handlers.append(log_handler)
-            log_levels.append(level_file)
-
-    for log_handler, level in zip(log_handlers, log_levels):
-        log_handler.setFormatter(logfmt)
-        log_handler.setLevel(level)
-        logger_.addHandler(log_handler)
-
-    logger_.setLevel(level_logger)
-    logger = DataAndTypeLoggerAdapter(logger_, default_type=default_type)
-    return logger
+                os.makedirs(log_directory_path, exist_ok=True)
+            if timed_rotate_split_error:
+                error_log_path = os.path.join(log_directory_path, 'error_logs.json')
+                all_log_path = os.path.join(log_directory_path, 'daily_log.json')
+                log_handlers.append(_BatchTimedRotatingFileHandler(error_log_path, **rotate_kwargs))
+                log_levels.append(logging.WARNING)
+                log_handlers.append(_BatchTimedRotatingFileHandler(all_log_path, **rotate_kwargs))
+                log_levels.append(logging.DEBUG)
+                level_logger = min(level_logger, logging.DEBUG)
+            else:
+                if filename is None:
+                    filename = f'{default_type}_log.json' if default_type else 'log.json'
+                log_path = os.path.join(log_directory_path, filename)
+                if rotate_log:
+                    log_handler = _BatchTimedRotatingFileHandler(log_path, **rotate_kwargs)
+                else:
+                    log_handler = _BatchFileHandler(log_path)
+                log_handlers.append(log_handler)
+                log_levels.append(level_file)
+
+        for log_handler, level in zip(log_handlers, log_levels):
+            log_handler.setFormatter(logfmt)
+            log_handler.setLevel(level)
+
+        log_queue = queue.SimpleQueue()
+        listener = _BatchQueueListener(log_queue, *log_handlers, respect_handler_level=True)
+        listener.start()
+        _listeners[name] = listener
+        logger_.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger_.setLevel(level_logger)
+        logger = DataAndTypeLoggerAdapter(logger_, default_type=default_type)
+        return logger
+
+
+"""
+headless benchmark, run with:
+    python date_and_type_logger.py
+"""
+
+def _bench(log_directory_path, n_commands=2000):
+    """time spent in logger.info per command (what enter waits for), writing
+       in the caller as before vs through the queue"""
+    import time
+
+    extra = {"title": 'prod "eu"', "ip": "10.0.0.1", "user": "root"}
+    old_logger = logging.getLogger("bench_sync")
+    old_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(log_directory_path, "sync.log"), when='D', interval=7)
+    old_handler.setFormatter(JsonFormatter())
+    old_logger.addHandler(old_handler)
+    old_logger.setLevel(logging.DEBUG)
+    new_logger = get_date_and_type_logger(
+        "bench_queue", default_type='ReplLog', to_stdout=False, to_file=True, rotate_log=True,
+        rotate_kwargs={'when': 'D', 'interval': 7}, log_directory_path=log_directory_path, filename="queue.log"
+    )
+    for label, logger in (("sync", DataAndTypeLoggerAdapter(old_logger, 'ReplLog')), ("queue", new_logger)):
+        times = []
+        for i in range(n_commands):
+            start = time.perf_counter()
+            logger.info(f"ls -la /var/log/{i}", extra=extra)
+            times.append(time.perf_counter() - start)
+            time.sleep(0.0005)  # commands are typed, not logged back to back
+        times.sort()
+        print(f"{label:>5}: mean {sum(times) / len(times) * 1e6:6.1f} us, p99 {times[len(times) * 99 // 100] * 1e6:6.1f} us")
+    old_handler.close()
+
+
+def main():
+    import shutil
+    import tempfile
+
+    log_directory_path = tempfile.mkdtemp()
+    try:
+        logger = get_date_and_type_logger("test", default_type='ReplLog', to_stdout=False,
+                                          log_directory_path=log_directory_path, filename="test.log")
+        assert get_date_and_type_logger("test").logger.handlers == logger.logger.handlers
+        logger.info('echo "a\\tb"', extra={"title": 'it\'s "prod"'})
+        _bench(log_directory_path)
+        stop_date_and_type_loggers()
+        with open(os.path.join(log_directory_path, "test.log"), encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 1, lines
+        entry = json.loads(lines[0])
+        assert entry["message"] == 'echo "a\\tb"' and entry["data"] == {"title": 'it\'s "prod"'}, entry
+        assert entry["type"] == "ReplLog"
+        with open(os.path.join(log_directory_path, "queue.log"), encoding="utf-8") as f:
+            assert sum(1 for _ in f) == 2000
+        print("ok")
+    finally:
+        shutil.rmtree(log_directory_path)
+
+
+if __name__ == '__main__':
+    main()
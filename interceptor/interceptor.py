@@ -114,7 +114,7 @@ class Interceptor:
         out_path = os.path.join(self._sftp_directory, filename).replace('\\', '/')
         try:
             os.makedirs(os.path.dirname(out_path), exist_ok=True)
-            with self._repl._client.open_sftp() as sftp:
+            with self._repl.open_sftp() as sftp:
                 sftp.get(path, out_path)
         except IOError:
             with open(out_path, 'w'):
@@ -212,7 +212,7 @@ class Interceptor:
 
     def put_file(self, src_path, dest_path):
         try:
-            with self._repl._client.open_sftp() as sftp:
+            with self._repl.open_sftp() as sftp:
                 sftp.put(src_path, dest_path)
         except Exception as e:
             print(e)
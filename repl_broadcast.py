@@ -0,0 +1,237 @@
+import queue
+import re
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# seconds every repl of a broadcast must be quiet before its output is shown
+BROADCAST_SETTLE_TIME = 1.0
+# seconds output is collected at most after a broadcast was written
+BROADCAST_TIMEOUT = 30.0
+# repls written to at the same time
+BROADCAST_WORKERS = 16
+
+# CSI, OSC and two character escapes, which would keep equal outputs apart
+_ESCAPE_REGEX = re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]")
+
+
+def fan_out(executor, writes):
+    """runs every write of {key: callable()} on executor and waits for all,
+       returns {key: (seconds, exception or None)}"""
+    def timed(write):
+        start = time.monotonic()
+        try:
+            write()
+        except Exception as e:
+            return time.monotonic() - start, e
+        return time.monotonic() - start, None
+    futures = {key: executor.submit(timed, write) for key, write in writes.items()}
+    return {key: future.result() for key, future in futures.items()}
+
+
+class Broadcaster:
+    """Writes commands to many repls at once.
+
+    Each broadcast is handed to a background thread, which starts every
+    write on a pool and waits for all of them: a broadcast takes as long
+    as its slowest repl instead of the sum, and the UI thread never waits
+    on a connection. Broadcasts are written one after another, so each
+    repl receives commands in the order they were sent."""
+
+    def __init__(self, workers=BROADCAST_WORKERS):
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def send(self, writes, on_done=None):
+        """writes: {key: callable()}, on_done(results) is called on the
+           broadcast thread with the results of fan_out"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ReplBroadcaster", daemon=True)
+                self._thread.start()
+        self._queue.put((writes, on_done))
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="repl_broadcast") as executor:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                writes, on_done = job
+                results = fan_out(executor, writes)
+                if on_done is not None:
+                    try:
+                        on_done(results)
+                    except Exception:
+                        traceback.print_exc()
+
+    def close(self):
+        """stops once the queued broadcasts are written"""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread = None
+
+
+class OutputCollector:
+    """Collects what each repl prints after a broadcast, until all of them
+    were quiet for settle seconds or timeout passed since the writes."""
+
+    def __init__(self, keys, settle=BROADCAST_SETTLE_TIME, timeout=BROADCAST_TIMEOUT):
+        self._settle = settle
+        self._timeout = timeout
+        self._cond = threading.Condition()
+        self._outputs = {key: [] for key in keys}
+        self._last_output = None
+        self._written_at = None
+        self.results = None
+
+    def output(self, key, text):
+        with self._cond:
+            self._outputs[key].append(text)
+            self._last_output = time.monotonic()
+            self._cond.notify()
+
+    def writes_done(self, results):
+        """results of fan_out, starts the settle time"""
+        with self._cond:
+            self.results = results
+            self._written_at = time.monotonic()
+            self._cond.notify()
+
+    def wait(self):
+        """blocks until the output settled, returns {key: text}"""
+        with self._cond:
+            while self._written_at is None:
+                self._cond.wait()
+            deadline = self._written_at + self._timeout
+            while True:
+                now = time.monotonic()
+                quiet_since = max(self._written_at, self._last_output or 0)
+                wait = min(quiet_since + self._settle, deadline) - now
+                if wait <= 0:
+                    return {key: "".join(texts) for key, texts in self._outputs.items()}
+                self._cond.wait(wait)
+
+    def start(self, on_ready):
+        """calls on_ready(outputs) from a new thread once the output settled"""
+        thread = threading.Thread(target=lambda: on_ready(self.wait()), name="ReplBroadcastCollector", daemon=True)
+        thread.start()
+
+
+def normalize_output(text, command=None):
+    """text a repl printed for command without colors, carriage returns,
+       the echoed command or the prompt that follows the output"""
+    text = _ESCAPE_REGEX.sub("", text).replace("\r\n", "\n")
+    lines = [line.rstrip("\r").rsplit("\r", 1)[-1] for line in text.split("\n")]
+    # the last line is the prompt, or empty if the output ended in a newline
+    lines.pop()
+    command = (command or "").strip().split("\n", 1)[0]
+    if lines and command and lines[0].rstrip().endswith(command):
+        lines.pop(0)
+    while lines and not lines[-1].strip():
+        lines.pop()
+    return "\n".join(lines)
+
+
+def group_outputs(outputs, command=None):
+    """[(text, keys)] of the keys of outputs whose normalized text is the
+       same, the largest group first"""
+    groups = {}
+    for key, text in outputs.items():
+        groups.setdefault(normalize_output(text, command), []).append(key)
+    return sorted(groups.items(), key=lambda group: -len(group[1]))
+
+
+def format_broadcast(command, labels, results, outputs):
+    """text of the broadcast view for one broadcast, results and outputs as
+       returned by fan_out and OutputCollector.wait, labels: {key: host name}"""
+    failed = {key: error for key, (seconds, error) in results.items() if error is not None}
+    slowest = max([seconds for seconds, error in results.values()] or [0])
+    lines = ["$ %s  [%d repls, written in %.2fs%s]" % (
+        command.strip(), len(results), slowest, ", %d failed" % (len(failed),) if failed else "")]
+    for text, keys in group_outputs({key: outputs[key] for key in results if key not in failed}, command):
+        names = ", ".join(labels[key] for key in keys)
+        lines.append("== %s (%d)" % (names, len(keys)) if len(keys) > 1 else "== " + names)
+        if text:
+            lines.extend("   " + line for line in text.split("\n"))
+        else:
+            lines.append("   (no output)")
+    for key, error in failed.items():
+        lines.append("== %s: write failed: %s" % (labels[key], error))
+    return "\n".join(lines) + "\n\n"
+
+
+BROADCASTER = Broadcaster()
+
+
+"""
+headless benchmark, run with:
+    python repl_broadcast.py
+"""
+
+def main():
+    import random
+
+    # output of four hosts, two of them alike but for colors and prompts
+    outputs = {
+        "web1": "uptime\r\n\x1b[0m 10:00 up 3 days\r\n[root@web1 ~]# ",
+        "web2": "uptime\r\n 10:00 up 3 days\r\n\r\n[root@web2 ~]# ",
+        "db1": "uptime\r\n 10:00 up 9 days\r\n[root@db1 ~]# ",
+        "db2": "",
+    }
+    groups = group_outputs(outputs, "uptime")
+    assert groups == [(" 10:00 up 3 days", ["web1", "web2"]), (" 10:00 up 9 days", ["db1"]), ("", ["db2"])], groups
+    assert normalize_output("50%\r75%\r100%\r\ndone\r\n$ ") == "100%\ndone"
+    text = format_broadcast("uptime", {key: key for key in outputs},
+                            {"web1": (0.1, None), "web2": (0.2, None), "db1": (0.1, None), "db2": (0.3, OSError("closed"))},
+                            outputs)
+    assert text == ("$ uptime  [4 repls, written in 0.30s, 1 failed]\n"
+                    "== web1, web2 (2)\n    10:00 up 3 days\n"
+                    "== db1\n    10:00 up 9 days\n"
+                    "== db2: write failed: closed\n\n"), text
+
+    collector = OutputCollector(["web1", "web2"], settle=0.1, timeout=1.0)
+    collector.output("web1", "a")
+    start = time.monotonic()
+    threading.Timer(0.05, collector.output, ("web2", "b")).start()
+    collector.writes_done({})
+    assert collector.wait() == {"web1": "a", "web2": "b"}
+    assert 0.1 <= time.monotonic() - start < 0.5
+
+    # a slow host holds up a broadcast by its own delay only
+    n_repls = 30
+    delays = [random.uniform(0.02, 0.1) for _ in range(n_repls)]
+    delays[0] = 0.3
+    writes = {i: lambda delay=delay: time.sleep(delay) for i, delay in enumerate(delays)}
+    for workers in (1, BROADCAST_WORKERS, n_repls):
+        done = threading.Event()
+        broadcaster = Broadcaster(workers)
+        start = time.monotonic()
+        broadcaster.send(writes, lambda results: done.set())
+        queued = time.monotonic() - start
+        done.wait()
+        elapsed = time.monotonic() - start
+        broadcaster.close()
+        print(f"{n_repls} repls, {workers:2} workers: sent in {queued * 1e3:.3f} ms, written in {elapsed:.2f} s "
+              f"(sum of writes {sum(delays):.2f} s, slowest {max(delays):.2f} s)")
+    assert elapsed < max(delays) + 0.1, elapsed
+
+    # writes to one repl keep their order across broadcasts
+    written = []
+    broadcaster = Broadcaster()
+    done = threading.Event()
+    for i in range(20):
+        broadcaster.send({"web1": lambda i=i: (time.sleep(random.uniform(0, 0.002)), written.append(i))})
+    broadcaster.send({}, lambda results: done.set())
+    done.wait()
+    broadcaster.close()
+    assert written == list(range(20)), written
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,654 @@
+import heapq
+import itertools
+import glob
+import json
+import os
+import re
+from bisect import bisect_left, insort
+import threading
+import time
+from datetime import datetime
+
+# appends are flushed to the os at once and fsynced at most this often
+HISTORY_FSYNC_INTERVAL = 1.0  # seconds
+# the file may hold this fraction more records than max_entries before it
+# is compacted
+HISTORY_COMPACT_SLACK = 0.5
+
+_stores = {}  # path: HistoryStore
+_stores_lock = threading.Lock()
+_file_locks = {}  # path: lock held while the file is migrated or seeded
+
+
+class HistoryIndex:
+    """Prefix index over commands in the order they were run.
+
+    Distinct commands are kept sorted, so the commands starting with a
+    prefix are a contiguous run found by bisection, and each command maps
+    to the positions it was run at to order matches by recency.
+    Matches are yielded newest first by merging the positions of those
+    commands, or for prefixes matching a large part of the history by
+    walking the commands backwards, which finds the next match sooner."""
+
+    # fraction of the history above which matching walks the commands
+    SCAN_FRACTION = 0.02
+
+    def __init__(self, commands=()):
+        self._commands = list(commands)
+        self._positions = {}  # command: [position, ...] ascending
+        for position, command in enumerate(self._commands):
+            self._positions.setdefault(command, []).append(position)
+        self._keys = sorted(self._positions)
+
+    def add(self, command):
+        positions = self._positions.get(command)
+        if positions is None:
+            self._positions[command] = [len(self._commands)]
+            insort(self._keys, command)
+        else:
+            positions.append(len(self._commands))
+        self._commands.append(command)
+
+    def _prefix_range(self, prefix):
+        """(lo, hi) such that self._keys[lo:hi] are the commands starting
+           with prefix"""
+        keys = self._keys
+        lo = bisect_left(keys, prefix)
+        last = ord(prefix[-1])
+        if last == 0x10ffff:
+            hi = lo
+            while hi < len(keys) and keys[hi].startswith(prefix):
+                hi += 1
+            return lo, hi
+        return lo, bisect_left(keys, prefix[:-1] + chr(last + 1), lo)
+
+    def _scan(self, prefix, end):
+        commands = self._commands
+        for position in range(end - 1, -1, -1):
+            if commands[position].startswith(prefix):
+                yield commands[position]
+
+    @staticmethod
+    def _merge(runs):
+        for _, command in heapq.merge(*runs, reverse=True):
+            yield command
+
+    def iter_matches(self, prefix, dedupe=False):
+        """lazily yields the commands starting with prefix, newest first.
+           With dedupe each command is yielded once, where it was last run.
+           Commands added while iterating are not yielded."""
+        end = len(self._commands)
+        if prefix:
+            lo, hi = self._prefix_range(prefix)
+        if not prefix or hi - lo > end * self.SCAN_FRACTION:
+            matches = self._scan(prefix, end)
+        else:
+            # reversed() starts at the current end, so later adds are skipped
+            positions = self._positions
+            matches = self._merge([zip(reversed(positions[command]), itertools.repeat(command))
+                                   for command in self._keys[lo:hi]])
+        if not dedupe:
+            return matches
+        return self._dedupe(matches)
+
+    @staticmethod
+    def _dedupe(matches):
+        seen = set()
+        for command in matches:
+            if command not in seen:
+                seen.add(command)
+                yield command
+
+    def match(self, prefix, dedupe=False):
+        """every command starting with prefix, oldest first"""
+        matches = list(self.iter_matches(prefix, dedupe))
+        matches.reverse()
+        return matches
+
+
+class HistorySearchIndex:
+    """Substring index over the distinct commands of a history.
+
+    Each command is listed under every trigram (three characters) of its
+    lowercased text, so a query only checks the commands sharing its
+    rarest trigram instead of the whole history. A query is split into
+    words that must all appear in a command, ignoring case unless the
+    query has upper case letters."""
+
+    def __init__(self, commands=()):
+        self._texts = []  # id: command
+        self._lower_texts = []  # id: lowercased command
+        self._last_used = []  # id: position the command was last run at
+        self._ids = {}  # command: id
+        self._trigrams = {}  # trigram: [id, ...] ascending
+        self._runs = []  # position: id of the command run there
+        for command in commands:
+            self.add(command)
+
+    def add(self, command):
+        command_id = self._ids.get(command)
+        if command_id is None:
+            command_id = self._ids[command] = len(self._texts)
+            lower_text = command.lower()
+            self._texts.append(command)
+            self._lower_texts.append(lower_text)
+            self._last_used.append(len(self._runs))
+            trigrams = self._trigrams
+            for trigram in {lower_text[i:i + 3] for i in range(len(lower_text) - 2)}:
+                ids = trigrams.get(trigram)
+                if ids is None:
+                    trigrams[trigram] = [command_id]
+                else:
+                    ids.append(command_id)
+        else:
+            self._last_used[command_id] = len(self._runs)
+        self._runs.append(command_id)
+
+    def _candidates(self, words):
+        """ids of the commands that may contain every word"""
+        smallest = None
+        for word in words:
+            for i in range(len(word) - 2):
+                ids = self._trigrams.get(word[i:i + 3], ())
+                if smallest is None or len(ids) < len(smallest):
+                    smallest = ids
+                    if not smallest:
+                        return ()
+        if smallest is None:
+            # no word is long enough to have a trigram
+            return range(len(self._texts))
+        return smallest
+
+    def search(self, query, limit=None):
+        """distinct commands containing every word of query, most
+           recently run first"""
+        words = query.split()
+        case_sensitive = query != query.lower()
+        texts = self._texts if case_sensitive else self._lower_texts
+        candidates = self._candidates([word.lower() for word in words])
+        if limit is not None and limit * len(self._runs) < len(candidates) ** 2:
+            # matches are common, walking back from the newest command
+            # reaches limit of them before checking every candidate
+            return self._search_recent(words, texts, limit)
+        ids = [command_id for command_id in candidates
+               if all(word in texts[command_id] for word in words)]
+        last_used = self._last_used
+        if limit is not None and limit < len(ids):
+            ids = heapq.nlargest(limit, ids, key=last_used.__getitem__)
+        else:
+            ids.sort(key=last_used.__getitem__, reverse=True)
+        return [self._texts[command_id] for command_id in ids]
+
+    def _search_recent(self, words, texts, limit):
+        seen = set()
+        matches = []
+        for command_id in reversed(self._runs):
+            if command_id in seen:
+                continue
+            seen.add(command_id)
+            if all(word in texts[command_id] for word in words):
+                matches.append(self._texts[command_id])
+                if len(matches) == limit:
+                    break
+        return matches
+
+
+def search_recent(commands, query, limit=None):
+    """distinct commands containing every word of query, newest first,
+       walking back through commands, for a history that is not indexed"""
+    words = query.split()
+    case_sensitive = query != query.lower()
+    seen = set()
+    matches = []
+    for command in reversed(commands):
+        if command in seen:
+            continue
+        seen.add(command)
+        text = command if case_sensitive else command.lower()
+        if all(word in text for word in words):
+            matches.append(command)
+            if len(matches) == limit:
+                break
+    return matches
+
+
+class BackgroundSearchIndex:
+    """HistorySearchIndex over a list of commands its owner appends to,
+    built on a background thread by the first search: building it takes
+    seconds for a long history. Searches meanwhile walk back through the
+    commands."""
+
+    def __init__(self, commands):
+        self._commands = commands
+        self._lock = threading.Lock()
+        self._index = None
+        self._n_indexed = 0
+        self._is_building = False
+        self._built = threading.Event()
+
+    def search(self, query, limit=None):
+        with self._lock:
+            index = self._index
+            if index is None:
+                if not self._is_building:
+                    self._is_building = True
+                    threading.Thread(target=self._build, name="HistorySearchIndex", daemon=True).start()
+            else:
+                # commands appended since the last search
+                for command in self._commands[self._n_indexed:]:
+                    index.add(command)
+                self._n_indexed = len(self._commands)
+        if index is None:
+            return search_recent(self._commands, query, limit)
+        return index.search(query, limit)
+
+    def _build(self):
+        n_indexed = len(self._commands)
+        index = HistorySearchIndex(self._commands[:n_indexed])
+        with self._lock:
+            self._index = index
+            self._n_indexed = n_indexed
+        self._built.set()
+
+    def wait(self):
+        """blocks until the index is built, building it here if no search
+           started it"""
+        with self._lock:
+            is_building, self._is_building = self._is_building, True
+        if is_building:
+            self._built.wait()
+        else:
+            self._build()
+
+
+def _read_records(path):
+    """records of a history file, skipping lines torn by a crash"""
+    records = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and isinstance(record.get("command"), str):
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def _write_records(path, records):
+    """writes records to path through a temporary file, so a crash leaves
+       either the old or the new file, never half of one"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="\n") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class HistoryStore:
+    """Append-only command history, one JSON record per line.
+
+    Appending writes a single line, so it costs the same however long the
+    history is. A line torn by a crash is skipped when loading. Once the
+    file holds HISTORY_COMPACT_SLACK more records than max_entries it is
+    rewritten with the newest max_entries.
+    Use get_history_store(), views sharing a file share one store."""
+
+    def __init__(self, path, max_entries=0):
+        self.path = path
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._records = self._load()
+        self._commands = [record["command"] for record in self._records]
+        self.index = HistoryIndex(self._commands)
+        self.search_index = BackgroundSearchIndex(self._commands)
+        self._file = None
+        self._last_fsync = 0
+
+    def _load(self):
+        return _read_records(self.path)
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8", newline="\n")
+            # terminate a line torn by a crash so the next record starts clean
+            if self._file.tell() > 0:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        self._file.write("\n")
+        return self._file
+
+    @property
+    def commands(self):
+        """every stored command, oldest first"""
+        return self._commands
+
+    def append(self, command, ts=None):
+        record = {"command": command, "ts": (ts or datetime.now()).isoformat(timespec="seconds")}
+        with self._lock:
+            f = self._open()
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            now = time.monotonic()
+            if now - self._last_fsync >= HISTORY_FSYNC_INTERVAL:
+                os.fsync(f.fileno())
+                self._last_fsync = now
+            self._records.append(record)
+            self._commands.append(command)
+            self.index.add(command)
+            if self._max_entries and len(self._records) > self._max_entries * (1 + HISTORY_COMPACT_SLACK):
+                self._compact()
+
+    def _compact(self):
+        records = self._records[-self._max_entries:]
+        self._close()
+        _write_records(self.path, records)
+        self._records = records
+        self._commands = [record["command"] for record in records]
+        self.index = HistoryIndex(self._commands)
+        self.search_index = BackgroundSearchIndex(self._commands)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def history_path(history_dir, external_id, host=None):
+    """path of the history file for external_id, or of its partition for
+       host (e.g. user@ip) if given"""
+    name = external_id if host is None else f"{external_id}@{host}"
+    return os.path.join(history_dir, re.sub(r"[^\w.@-]", "_", name) + ".jsonl")
+
+
+def merged_commands(history_dir, external_id):
+    """commands of every partition of external_id, in the order they were
+       run. The history from before partitioning is included too."""
+    paths = [history_path(history_dir, external_id)]
+    paths.extend(sorted(glob.glob(glob.escape(history_path(history_dir, external_id, "")[:-len(".jsonl")]) + "*.jsonl")))
+    runs = [_read_records(paths[0])]
+    runs.extend([record for record in _read_records(path) if not record.get("seeded")] for path in paths[1:])
+    records = heapq.merge(*runs, key=lambda record: record.get("ts") or "")
+    return [record["command"] for record in records]
+
+
+def _file_lock(path):
+    with _stores_lock:
+        return _file_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def seed_partition(history_dir, external_id, host):
+    """Starts the partition of host with the history of external_id from
+       before partitioning, if the partition does not exist yet, so views
+       keep recalling it. Seeded records are marked, merged_commands()
+       reads them from the unpartitioned file only.
+       Returns True if the partition was seeded."""
+    path = history_path(history_dir, external_id, host)
+    with _file_lock(path):
+        with _stores_lock:
+            if path in _stores:
+                return False
+        if os.path.exists(path):
+            return False
+        records = _read_records(history_path(history_dir, external_id))
+        if not records:
+            return False
+        _write_records(path, [dict(record, seeded=True) for record in records])
+        return True
+
+
+def get_history_store(path, max_entries=0):
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = HistoryStore(path, max_entries)
+        return store
+
+
+def migrate_pydblite(db_path, path):
+    """Imports a PyDbLite history database into an append-only file at
+       path, the database is kept renamed to *.migrated.
+       Returns True if anything was migrated. Concurrent calls for one
+       database, from plugin_loaded and an opening view, migrate it once."""
+    with _file_lock(db_path):
+        return _migrate_pydblite(db_path, path)
+
+
+def _migrate_pydblite(db_path, path):
+    if os.path.exists(path) or not os.path.isfile(db_path):
+        return False
+    try:
+        from .repllibs import PyDbLite
+    except ImportError:
+        from repllibs import PyDbLite
+    db = PyDbLite.Base(db_path).create("external_id", "command", "ts", mode="open")
+    records = []
+    for record in sorted(db, key=lambda record: record["__id__"]):
+        ts = record.get("ts")
+        records.append({
+            "command": record["command"],
+            "ts": ts.isoformat(timespec="seconds") if isinstance(ts, datetime) else None,
+        })
+    _write_records(path, records)
+    os.replace(db_path, db_path + ".migrated")
+    return True
+
+
+def migrate_history_dir(history_dir):
+    """Migrates every PyDbLite *.db history in history_dir"""
+    if not os.path.isdir(history_dir):
+        return
+    for file_name in os.listdir(history_dir):
+        name, ext = os.path.splitext(file_name)
+        if ext != ".db":
+            continue
+        try:
+            migrate_pydblite(os.path.join(history_dir, file_name), os.path.join(history_dir, name + ".jsonl"))
+        except Exception as e:
+            print(e)
+
+
+"""
+headless benchmark, run with:
+    python repl_history.py
+"""
+
+def _bench_append():
+    """PyDbLite commit per command vs HistoryStore.append"""
+    import shutil
+    import tempfile
+    from repllibs import PyDbLite
+
+    n_commands = 2000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db = PyDbLite.Base(os.path.join(tmp_dir, "bench.db"))
+        db.create("external_id", "command", "ts", mode="open")
+        start = time.perf_counter()
+        for i in range(n_commands):
+            db.insert(external_id="bench", command=f"ls -la /var/log/{i}", ts=datetime.now())
+            db.commit()
+        pydblite = time.perf_counter() - start
+
+        store = HistoryStore(os.path.join(tmp_dir, "bench.jsonl"))
+        start = time.perf_counter()
+        for i in range(n_commands):
+            store.append(f"ls -la /var/log/{i}")
+        append = time.perf_counter() - start
+        store.close()
+        print(f"{n_commands} commands: PyDbLite {pydblite / n_commands * 1e6:8.1f} us/command, "
+              f"append-only {append / n_commands * 1e6:6.1f} us/command")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _bench_match():
+    """full startswith scan vs the first page of HistoryIndex.iter_matches
+       on 100k commands"""
+    import random
+
+    random.seed(0)
+    words = ['ls', 'cd', 'git', 'docker', 'kubectl', 'python', 'grep', 'tail', 'ssh', 'vi']
+    commands = [f'{random.choice(words)} {random.choice(words)}-{random.randrange(20000)}' for _ in range(100_000)]
+    index = HistoryIndex(commands)
+    page_size = 32
+    for prefix in ('', 'git', 'docker ls-1', 'kubectl tail-1234'):
+        n_repeat = 20
+        start = time.perf_counter()
+        for _ in range(n_repeat):
+            scan = [command for command in commands if command.startswith(prefix)]
+        scan_time = (time.perf_counter() - start) / n_repeat
+        start = time.perf_counter()
+        for _ in range(n_repeat):
+            page = list(itertools.islice(index.iter_matches(prefix), page_size))
+        page_time = (time.perf_counter() - start) / n_repeat
+        assert page == scan[::-1][:page_size]
+        assert index.match(prefix) == scan
+        assert index.match(prefix, dedupe=True) == list(reversed(dict.fromkeys(reversed(scan))))
+        print(f'prefix {prefix!r:>20}: {len(scan):6} matches, scan {scan_time * 1e3:7.2f} ms, '
+              f'first page {page_time * 1e3:7.3f} ms')
+
+
+def _bench_search():
+    """linear substring scan vs HistorySearchIndex.search on 300k commands"""
+    import random
+
+    random.seed(0)
+    words = ['ls', 'cd', 'git', 'docker', 'kubectl', 'python', 'grep', 'tail', 'ssh', 'vi']
+    commands = [f'{random.choice(words)} --{random.choice(words)}=/srv/{random.randrange(100000)}/{random.choice(words)}'
+                for _ in range(300_000)]
+    start = time.perf_counter()
+    index = HistorySearchIndex(commands)
+    print(f'index {len(commands)} commands: {(time.perf_counter() - start) * 1e3:7.0f} ms')
+    for query in ('docker', 'srv/4242', '9999/vi', 'kubectl 12345', 'nothing'):
+        n_repeat = 5
+        start = time.perf_counter()
+        for _ in range(n_repeat):
+            scan = list(dict.fromkeys(command for command in reversed(commands)
+                                      if all(word in command for word in query.split())))
+        scan_time = (time.perf_counter() - start) / n_repeat
+        start = time.perf_counter()
+        for _ in range(n_repeat):
+            matches = index.search(query)
+        search_time = (time.perf_counter() - start) / n_repeat
+        start = time.perf_counter()
+        for _ in range(n_repeat):
+            page = index.search(query, limit=32)
+        page_time = (time.perf_counter() - start) / n_repeat
+        assert matches == scan
+        assert page == scan[:32]
+        print(f'query {query!r:>16}: {len(matches):6} matches, scan {scan_time * 1e3:7.2f} ms, '
+              f'index {search_time * 1e3:7.2f} ms, 32 newest {page_time * 1e3:7.2f} ms')
+
+
+def main():
+    import shutil
+    import tempfile
+    from repllibs import PyDbLite
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # migration keeps the order of commands
+        db_path = os.path.join(tmp_dir, "ssh.db")
+        db = PyDbLite.Base(db_path)
+        db.create("external_id", "command", "ts", mode="open")
+        for command in ("ls", "cd /tmp", "ls"):
+            db.insert(external_id="ssh", command=command, ts=datetime.now())
+        db.commit()
+        migrated = []
+        threads = [threading.Thread(target=lambda: migrated.append(
+                       migrate_pydblite(db_path, os.path.join(tmp_dir, "ssh.jsonl")))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        migrate_history_dir(tmp_dir)
+        for thread in threads:
+            thread.join()
+        assert migrated.count(True) <= 1, migrated
+        path = os.path.join(tmp_dir, "ssh.jsonl")
+        assert os.path.isfile(db_path + ".migrated")
+        store = HistoryStore(path, max_entries=4)
+        assert store.commands == ["ls", "cd /tmp", "ls"]
+
+        # a torn last line is skipped and does not swallow the next record
+        store.close()
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"command": "tor')
+        store = HistoryStore(path, max_entries=4)
+        store.append("pwd")
+        assert store.commands == ["ls", "cd /tmp", "ls", "pwd"]
+        assert HistoryStore(path).commands == store.commands
+
+        # compaction keeps the newest max_entries
+        for command in ("a", "b", "c"):
+            store.append(command)
+        assert store.commands == ["pwd", "a", "b", "c"], store.commands
+        store.close()
+        assert HistoryStore(path).commands == store.commands
+        # searched by a walk until the index is built in the background
+        assert store.search_index.search("a") == ["a"]
+        store.search_index.wait()
+        store.append("ab")
+        assert store.search_index._index is not None
+        assert store.search_index.search("a") == ["ab", "a"]
+        assert search_recent(store.commands, "A") == []
+
+        # partitions are merged by time, with the history from before them
+        store.close()
+        for host, command, ts in (("root@10.0.0.2", "top", 2), ("root@10.0.0.1", "df", 1), ("root@10.0.0.1", "du", 3)):
+            HistoryStore(history_path(tmp_dir, "ssh", host)).append(command, datetime(2100, 1, 1, 0, 0, ts))
+        assert os.path.basename(history_path(tmp_dir, "ssh", "me@fe80::1")) == "ssh@me@fe80__1.jsonl"
+        assert HistoryStore(history_path(tmp_dir, "ssh", "root@10.0.0.1")).commands == ["df", "du"]
+        assert merged_commands(tmp_dir, "ssh") == store.commands + ["df", "top", "du"]
+
+        # a new host partition starts with the unpartitioned history, which
+        # merging does not repeat
+        assert seed_partition(tmp_dir, "ssh", "root@10.0.0.3")
+        assert not seed_partition(tmp_dir, "ssh", "root@10.0.0.3")
+        assert not seed_partition(tmp_dir, "ssh", "root@10.0.0.1")
+        seeded = HistoryStore(history_path(tmp_dir, "ssh", "root@10.0.0.3"))
+        assert seeded.commands == store.commands
+        seeded.append("w", datetime(2100, 1, 1, 0, 0, 4))
+        assert merged_commands(tmp_dir, "ssh") == store.commands + ["df", "top", "du", "w"]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    index = HistoryIndex(["ls", "cd /tmp", "ls -la", "ls"])
+    index.add("cat x")
+    index.add("ls -la")
+    assert index.match("ls") == ["ls", "ls -la", "ls", "ls -la"]
+    assert index.match("ls", dedupe=True) == ["ls", "ls -la"]
+    assert index.match("") == ["ls", "cd /tmp", "ls -la", "ls", "cat x", "ls -la"]
+    assert index.match("x") == []
+    matches = index.iter_matches("ls")
+    index.add("ls -l")
+    assert list(matches) == ["ls -la", "ls", "ls -la", "ls"]
+
+    search_index = HistorySearchIndex(["git status", "ls /tmp", "git log --graph", "Git status"])
+    search_index.add("git status")
+    assert search_index.search("status") == ["git status", "Git status"]
+    assert search_index.search("Git") == ["Git status"]
+    assert search_index.search("git gra") == ["git log --graph"]
+    assert search_index.search("s") == ["git status", "Git status", "ls /tmp"]
+    assert search_index.search("s", limit=2) == ["git status", "Git status"]
+    assert search_index.search("xyz") == []
+    print("ok")
+    _bench_append()
+    _bench_match()
+    _bench_search()
+
+
+if __name__ == '__main__':
+    main()
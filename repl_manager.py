@@ -53,15 +53,19 @@ class ReplManager(object):
             return type, kwds
         if not sublime.load_settings(SETTINGS_FILE).get("use_paramiko", False) or not CAN_USE_PARAMIKO:
             type = 'ssh'
-            user = kwds.pop('user')
+            user = kwds.pop('user', None)
             ip = kwds.pop('ip')
-            key = kwds.pop('key')
-            kwds['cmd'] = ["ssh", "-tt", "-i", key, f"{user}@{ip}"]
+            key = kwds.pop('key', None)
+            # without a user or key openssh uses the configured ones, like paramiko
+            kwds['cmd'] = ["ssh", "-tt"] + (["-i", key] if key else []) + [f"{user}@{ip}" if user else ip]
         return type, kwds
 
     def open(self, window, encoding, type, syntax=None, view_id=None, title=None, show_error=True, **kwds):
         if type == 'winpty' and not CAN_USE_WINPTY:
             raise Exception("winpty dependancy error!")
+        # before the openssh fallback drops them from kwds
+        ip = kwds.get('ip')
+        user = kwds.get('user')
         type, kwds = self._check_paramiko(type, kwds)
         repl_restart_args = {
             'encoding': encoding,
@@ -80,9 +84,8 @@ class ReplManager(object):
                     break
             view = found or window.new_file()
 
-            ip = kwds.get('ip')
-            user = kwds.get('user')
-            rv = ReplView(view, r, syntax, repl_restart_args, title=title, ip=ip, user=user)
+            rv = ReplView(view, r, syntax, repl_restart_args, title=title,
+                          ip=kwds.get('ip', ip), user=kwds.get('user', user))
             rv.call_on_close.append(self._delete_repl)
             self.repl_views[r.id] = rv
             view.set_scratch(True)
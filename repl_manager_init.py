@@ -1,7 +1,16 @@
 import sublime
 import sublime_plugin
 
+from fnmatch import fnmatch
+import functools
+import gzip
+import os
+import time
+
+from . import SETTINGS_FILE
+from .repl_broadcast import BROADCASTER, BROADCAST_SETTLE_TIME, BROADCAST_TIMEOUT, OutputCollector, format_broadcast
 from .repl_manager import ReplManager
+from .sublimerepl import SESSION_DIR
 
 
 manager = ReplManager()
@@ -16,6 +25,113 @@ class ReplOpenCommand(sublime_plugin.WindowCommand):
         manager.open(self.window, encoding, type, syntax, view_id, **kwds)
 
 
+class ReplReplaySessionCommand(sublime_plugin.WindowCommand):
+    """Replays a recorded session into a new repl view, picked from the
+    recordings if no path is given. speed defaults to replay_speed."""
+
+    def run(self, path=None, speed=None):
+        if speed is None:
+            speed = sublime.load_settings(SETTINGS_FILE).get("replay_speed", 1.0)
+        if path is not None:
+            manager.open(self.window, "utf-8", "replay", path=path, speed=speed,
+                         title="*REPLAY* [%s]" % (os.path.basename(path),))
+            return
+        session_dir = os.path.join(sublime.packages_path(), SESSION_DIR)
+        paths = []
+        if os.path.isdir(session_dir):
+            paths = [os.path.join(session_dir, file_name) for file_name in os.listdir(session_dir)
+                     if file_name.endswith(".cast")]
+        if not paths:
+            sublime.status_message("no recorded sessions in %s" % (session_dir,))
+            return
+        paths.sort(key=os.path.getmtime, reverse=True)
+        items = [[os.path.basename(path), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(path)))]
+                 for path in paths]
+
+        def on_done(index):
+            if index == -1:
+                return
+            self.run(paths[index], speed)
+        self.window.show_quick_panel(items, on_done)
+
+
+def broadcast_targets(window, hosts=None):
+    """Live repl views of window a broadcast goes to: the selected tabs if
+       more than one repl is selected, else all of them, less those whose
+       host name or ip matches none of the hosts patterns"""
+    rvs = [rv for rv in manager.repl_views.values()
+           if rv.view.window() == window and rv.repl.is_alive() and rv.repl.TYPE != "replay"]
+    if hasattr(window, "selected_sheets"):  # ST4
+        selected = set(sheet.view().id() for sheet in window.selected_sheets() if sheet.view() is not None)
+        selected_rvs = [rv for rv in rvs if rv.view.id() in selected]
+        if len(selected_rvs) > 1:
+            rvs = selected_rvs
+    if hosts:
+        rvs = [rv for rv in rvs if any(fnmatch(rv.host_name, pattern) or fnmatch(rv.host_name.rpartition("@")[2], pattern)
+                                       for pattern in hosts)]
+    return rvs
+
+
+def broadcast_output_view(window):
+    """the view of window listing broadcast outputs, made on first use"""
+    for view in window.views():
+        if view.settings().get("repl_broadcast_output"):
+            return view
+    active = window.active_view()
+    view = window.new_file()
+    view.set_scratch(True)
+    view.set_name("*REPL broadcast*")
+    view.settings().set("repl_broadcast_output", True)
+    if active is not None:
+        window.focus_view(active)
+    return view
+
+
+def broadcast(window, rvs, command):
+    """Enters command in every repl view of rvs, the writes go out in
+       parallel. The output of each repl is collected until all of them
+       are quiet and listed per host in the broadcast view, identical
+       outputs once."""
+    settings = sublime.load_settings(SETTINGS_FILE)
+    labels = {}
+    writes = {}
+    for rv in rvs:
+        labels[rv.repl.id] = rv.host_name
+        writes[rv.repl.id] = functools.partial(rv.send_input, *rv.take_input(command))
+    collector = OutputCollector(writes, settle=settings.get("broadcast_settle_time", BROADCAST_SETTLE_TIME),
+                                timeout=settings.get("broadcast_timeout", BROADCAST_TIMEOUT))
+
+    def on_output(rv, text):
+        collector.output(rv.repl.id, text)
+    for rv in rvs:
+        rv.output_listeners.append(on_output)
+
+    def show(outputs):
+        for rv in rvs:
+            if on_output in rv.output_listeners:
+                rv.output_listeners.remove(on_output)
+        text = format_broadcast(command, labels, collector.results, outputs)
+        broadcast_output_view(window).run_command("append", {"characters": text, "force": True, "scroll_to_end": True})
+    BROADCASTER.send(writes, collector.writes_done)
+    collector.start(lambda outputs: sublime.set_timeout(lambda: show(outputs), 0))
+
+
+class ReplBroadcastCommand(sublime_plugin.WindowCommand):
+    """Enters command, asked for if not given, in the repls picked by
+    broadcast_targets"""
+
+    def run(self, command=None, hosts=None):
+        rvs = broadcast_targets(self.window, hosts)
+        if not rvs:
+            sublime.status_message("no repl to broadcast to")
+            return
+        if command is not None:
+            broadcast(self.window, rvs, command)
+            return
+        self.window.show_input_panel("broadcast to %d repls:" % (len(rvs),), "",
+                                     lambda command: broadcast(self.window, rvs, command), None, None)
+
+
 class ReplRestartCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         manager.restart(self.view, edit)
@@ -35,10 +151,36 @@ class ReplRestartCommand(sublime_plugin.TextCommand):
 class ReplEnterCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         rv = manager.repl_view(self.view)
-        if rv:
+        if not rv:
+            return
+        if self.view.settings().get("repl_broadcast_mode"):
+            window = self.view.window()
+            rvs = broadcast_targets(window)
+            if rv not in rvs:
+                rvs.append(rv)
+            broadcast(window, rvs, rv.user_input)
+        else:
             rv.enter()
 
 
+class ReplBroadcastModeCommand(sublime_plugin.TextCommand):
+    """Toggles entering input of this view in every repl broadcast goes to"""
+    def run(self, edit):
+        settings = self.view.settings()
+        settings.set("repl_broadcast_mode", not settings.get("repl_broadcast_mode", False))
+        sublime.status_message("broadcast mode %s" % ("on" if settings.get("repl_broadcast_mode") else "off",))
+
+    def is_visible(self):
+        rv = manager.repl_view(self.view)
+        return bool(rv)
+
+    def is_enabled(self):
+        return self.is_visible()
+
+    def is_checked(self):
+        return bool(self.view.settings().get("repl_broadcast_mode"))
+
+
 class ReplClearCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         rv = manager.repl_view(self.view)
@@ -127,6 +269,52 @@ class ReplViewNextCommand(sublime_plugin.TextCommand):
             rv.next_command(edit)
 
 
+class ReplHistorySearchCommand(sublime_plugin.TextCommand):
+    """Bash-style reverse-i-search: the newest command containing the typed
+    words is shown as you type, enter lists every match to pick from"""
+
+    # most matches listed in the quick panel
+    LIMIT = 1000
+
+    def run(self, edit):
+        rv = manager.repl_view(self.view)
+        if not rv:
+            return
+        window = self.view.window()
+
+        def on_change(query):
+            matches = rv.search_history(query, limit=1)
+            sublime.status_message("reverse-i-search: %s" % (matches[0] if matches else "no match",))
+
+        def on_done(query):
+            matches = rv.search_history(query, limit=self.LIMIT)
+            if not matches:
+                sublime.status_message("reverse-i-search: no match")
+                return
+
+            def on_select(index):
+                if index == -1:
+                    return
+                self.view.run_command("repl_replace_input", {"text": matches[index]})
+            window.show_quick_panel(matches, on_select)
+
+        window.show_input_panel("reverse-i-search:", rv.user_input, on_done, on_change, None)
+
+    def is_visible(self):
+        rv = manager.repl_view(self.view)
+        return bool(rv)
+
+    def is_enabled(self):
+        return self.is_visible()
+
+
+class ReplReplaceInputCommand(sublime_plugin.TextCommand):
+    def run(self, edit, text):
+        rv = manager.repl_view(self.view)
+        if rv:
+            rv.replace_current_input(edit, text)
+
+
 class ReplTabCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         rv = manager.repl_view(self.view)
@@ -148,6 +336,25 @@ class ReplKillCommand(sublime_plugin.TextCommand):
         return self.is_visible()
 
 
+class ReplOpenScrollbackArchiveCommand(sublime_plugin.TextCommand):
+    """Opens output trimmed from this repl view in a new scratch view"""
+    def run(self, edit):
+        path = self.view.settings().get("repl_scrollback_archive")
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            text = f.read()
+        view = self.view.window().new_file()
+        view.set_scratch(True)
+        view.set_name("*REPL scrollback* [%s]" % (self.view.name(),))
+        view.run_command("append", {"characters": text})
+
+    def is_visible(self):
+        path = self.view.settings().get("repl_scrollback_archive")
+        return bool(path) and os.path.isfile(path)
+
+    def is_enabled(self):
+        return self.is_visible()
+
+
 class SublimeReplListener(sublime_plugin.EventListener):
     def on_selection_modified(self, view):
         rv = manager.repl_view(view)
@@ -0,0 +1,313 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+import traceback
+
+
+# most output one frame passes on, in read buffers
+FRAME_BUDGET_BUFFERS = 8
+# what is left after a frame: nothing until new output, more output, or
+# nothing at all as the repl ended
+FRAME_IDLE, FRAME_MORE, FRAME_FINISHED = range(3)
+
+
+def drain_queue(q, handle_packets, read_buffer, is_alive, budget=None):
+    """Passes what is queued in q to handle_packets(list_of_packets),
+       flushing each time the accumulated length reaches read_buffer.
+       Packets are joined once per flush by the caller so bulk output stays
+       linear. With a budget, stops after the packets queued at the start,
+       or budget characters, so a reader outpacing the view cannot hold the
+       caller forever. Output of a repl no longer alive is dropped up to
+       the sentinel. Returns False once the None sentinel is read."""
+    ret = True
+    packets = []
+    size = 0
+    n_left = q.qsize() if budget is not None else -1
+    total = 0
+    try:
+        while is_alive() and n_left != 0 and (budget is None or total < budget):
+            n_left -= 1
+            packet = q.get_nowait()
+            if packet is None:
+                ret = False
+                break
+            packets.append(packet)
+            size += len(packet)
+            total += len(packet)
+            if size >= read_buffer:
+                handle_packets(packets)
+                packets = []
+                size = 0
+    except queue.Empty:
+        pass
+    if packets:
+        handle_packets(packets)
+    if ret and not is_alive():
+        try:
+            while q.get_nowait() is not None:
+                pass
+            ret = False
+        except queue.Empty:
+            pass
+    return ret
+
+
+def drain_frame(q, handle_packets, read_buffer, is_alive, is_reader_finished):
+    """Drains one frame's worth of q, see drain_queue, and returns what is
+       left: FRAME_MORE if queued output did not fit the frame,
+       FRAME_FINISHED once the repl ended and its reader is done, else
+       FRAME_IDLE"""
+    is_still_working = drain_queue(q, handle_packets, read_buffer, is_alive,
+                                   budget=FRAME_BUDGET_BUFFERS * read_buffer)
+    if is_still_working and is_alive() and not q.empty():
+        return FRAME_MORE
+    if is_still_working and not (is_reader_finished() and not is_alive()):
+        return FRAME_IDLE
+    return FRAME_FINISHED
+
+
+class ReplViewUpdater(threading.Thread):
+    """Single worker thread servicing every ReplView.
+
+    ReplReader threads call notify() whenever they queue new output, so idle
+    views cost nothing and new output is picked up as soon as it arrives
+    instead of on the next tick of a per-view polling loop.
+    Notifications for the same callback are coalesced until it runs.
+    A delay (seconds) defers the callback, used to hold output until the
+    next frame."""
+
+    def __init__(self):
+        super(ReplViewUpdater, self).__init__(name="ReplViewUpdater")
+        self.daemon = True
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._pending = {}  # used as an ordered set of callbacks
+        self._timers = []  # heap of (due, seq, callback)
+        self._timer_seq = itertools.count()
+        self._is_started = False
+
+    def notify(self, callback, delay=None):
+        with self._lock:
+            if delay:
+                heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), callback))
+            else:
+                self._pending[callback] = None
+            if not self._is_started:
+                self._is_started = True
+                self.start()
+        self._event.set()
+
+    def _pop_due(self):
+        """moves expired timers to pending, returns seconds until the next one"""
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self._timers)
+            self._pending[callback] = None
+        if self._timers:
+            return self._timers[0][0] - now
+        return None
+
+    def run(self):
+        timeout = None
+        while True:
+            self._event.wait(timeout)
+            self._event.clear()
+            with self._lock:
+                timeout = self._pop_due()
+                pending = self._pending
+                self._pending = {}
+            for callback in pending:
+                try:
+                    callback()
+                except Exception:
+                    traceback.print_exc()
+
+
+"""
+headless benchmarks, run with:
+    python repl_view_updater.py
+"""
+
+def _bench_update_loop():
+    """old per-view polling loop vs ReplViewUpdater"""
+    import time
+
+    n_views = 30
+    n_echoes = 200
+    idle_seconds = 2.0
+
+    class MockReader:
+        def __init__(self):
+            self.queue = queue.Queue()
+            self.on_output = None
+
+        def put(self, packet):
+            self.queue.put(packet)
+            if self.on_output is not None:
+                self.on_output()
+
+    class MockView:
+        def __init__(self, reader):
+            self.reader = reader
+            self.latencies = []
+            self.done = False
+
+        def handle_repl_output(self):
+            try:
+                while True:
+                    packet = self.reader.queue.get_nowait()
+                    if packet is None:
+                        self.done = True
+                        return False
+                    self.latencies.append(time.perf_counter() - packet)
+            except queue.Empty:
+                return True
+
+    def polling(views):
+        def loop(view):
+            while view.handle_repl_output():
+                time.sleep(0.01)
+        for view in views:
+            threading.Thread(target=loop, args=(view,), daemon=True).start()
+
+    def event_driven(views):
+        updater = ReplViewUpdater()
+        for view in views:
+            view.reader.on_output = lambda view=view: updater.notify(view.handle_repl_output)
+
+    def measure(name, setup):
+        views = [MockView(MockReader()) for _ in range(n_views)]
+        setup(views)
+        cpu_start = time.process_time()
+        time.sleep(idle_seconds)
+        idle_cpu = time.process_time() - cpu_start
+        active = views[0]
+        for _ in range(n_echoes):
+            active.reader.put(time.perf_counter())
+            time.sleep(0.002)
+        for view in views:
+            view.reader.put(None)
+        while not all(view.done for view in views):
+            time.sleep(0.01)
+        latencies = sorted(active.latencies)
+        mean = sum(latencies) / len(latencies)
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f'{name:>12}: idle cpu {idle_cpu / idle_seconds * 100:6.2f}% '
+              f'echo latency mean {mean * 1000:6.3f} ms p99 {p99 * 1000:6.3f} ms '
+              f'({n_views} views)')
+
+    measure('polling', polling)
+    measure('event-driven', event_driven)
+
+
+def _bench_drain():
+    """old `text += packet` drain vs drain_queue, 50 MB through the queue"""
+    import time
+
+    packet = ('x' * 79 + '\n') * 50
+    n_packets = 50 * 1024 * 1024 // len(packet)
+
+    def drain_concat(q, handle_packet, read_buffer):
+        text = ''
+        try:
+            while True:
+                packet = q.get_nowait()
+                if packet is None:
+                    break
+                text += packet
+                if len(text) >= read_buffer:
+                    handle_packet(text)
+                    text = ''
+        except queue.Empty:
+            pass
+        if len(text):
+            handle_packet(text)
+
+    def drain_join(q, handle_packet, read_buffer):
+        drain_queue(q, lambda packets: handle_packet(''.join(packets)), read_buffer, lambda: True)
+
+    for name, drain in (('concat', drain_concat), ('join', drain_join)):
+        # default READ_BUFFER, and one large enough that nothing flushes early
+        for read_buffer in (32_768, 50 * 1024 * 1024):
+            q = queue.Queue()
+            for _ in range(n_packets):
+                q.put(packet)
+            q.put(None)
+            total = [0]
+            start = time.perf_counter()
+            drain(q, lambda text: total.__setitem__(0, total[0] + len(text)), read_buffer)
+            elapsed = time.perf_counter() - start
+            print(f'{name:>6} read_buffer {read_buffer:>9}: {total[0] / elapsed / 1024 / 1024:8.1f} MB/s')
+
+
+def _bench_flood():
+    """one frame while a reader outpaces the view, 10 ms per 32 KB handled"""
+    import time
+
+    read_buffer = 32_768
+    packet = 'x' * 4096
+    n_flushes = [0]
+
+    def handle_packets(packets):
+        n_flushes[0] += 1
+        time.sleep(0.01)
+    for name, budget in (('unbounded', None), ('budget', FRAME_BUDGET_BUFFERS * read_buffer)):
+        q = queue.Queue()
+        stop = threading.Event()
+
+        def produce():
+            while not stop.is_set():
+                for _ in range(64):
+                    q.put(packet)
+                time.sleep(0.001)
+        threading.Thread(target=produce, daemon=True).start()
+        time.sleep(0.05)
+        n_flushes[0] = 0
+        # the unbounded frame only ends when the repl is cut off
+        deadline = time.monotonic() + 3
+        start = time.perf_counter()
+        drain_queue(q, handle_packets, read_buffer, lambda: time.monotonic() < deadline, budget)
+        print(f'{name:>9} frame: {(time.perf_counter() - start) * 1e3:7.1f} ms, {n_flushes[0]} flushes')
+        stop.set()
+    assert n_flushes[0] <= FRAME_BUDGET_BUFFERS
+
+
+def _check_killed_frames():
+    """a view killed with output queued finishes in one frame"""
+    updater = ReplViewUpdater()
+    q = queue.Queue()
+    for _ in range(100):
+        q.put('x' * 4096)
+    q.put(None)
+    n_frames = [0]
+    finished = threading.Event()
+
+    def update_view():
+        n_frames[0] += 1
+        left = drain_frame(q, lambda packets: None, 32_768, lambda: False, lambda: True)
+        if left == FRAME_MORE:
+            updater.notify(update_view, delay=0.001)
+        elif left == FRAME_FINISHED:
+            finished.set()  # the closing banner is written here
+    updater.notify(update_view)
+    assert finished.wait(1)
+    time.sleep(0.05)
+    assert n_frames[0] == 1 and q.empty(), n_frames[0]
+
+    # an alive repl with more than a frame queued gets further frames
+    for _ in range(100):
+        q.put('x' * 4096)
+    assert drain_frame(q, lambda packets: None, 32_768, lambda: True, lambda: False) == FRAME_MORE
+
+
+def main():
+    _check_killed_frames()
+    _bench_update_loop()
+    _bench_drain()
+    _bench_flood()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,3 +9,4 @@ from .sublimeutop_repl import *
 from .ssh_repl import *
 from .ssh_paramiko_repl import *
 from .winpty_repl import *
+from .replay_repl import *
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+
+class _CacheEntry:
+    def __init__(self):
+        self.lock = threading.Lock()  # held while loading
+        self.stamp = None
+        self.value = None
+
+
+class ParsedFileCache:
+    """Keeps what load(path) returned for each file until its mtime or size
+    changes, so reconnects skip reading and parsing it again (decrypting an
+    RSA private key takes milliseconds). Concurrent gets of one file wait
+    for a single load, a failed load is retried by the next get."""
+
+    def __init__(self, load):
+        self._load = load
+        self._lock = threading.Lock()
+        self._entries = {}  # real path: _CacheEntry
+
+    def get(self, path):
+        path = os.path.realpath(os.path.expanduser(path))
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = self._entries[path] = _CacheEntry()
+        with entry.lock:
+            if entry.stamp != stamp:
+                entry.value = self._load(path)
+                entry.stamp = stamp
+            return entry.value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+"""
+headless check with a fake key parser, run with:
+    python repls/parsed_file_cache.py
+"""
+
+def main():
+    import shutil
+    import tempfile
+
+    n_loads = []
+
+    def load(path):
+        time.sleep(0.05)  # read and decrypt
+        n_loads.append(path)
+        with open(path) as f:
+            return f.read()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "id_ed25519")
+        with open(path, "w") as f:
+            f.write("key 1")
+        cache = ParsedFileCache(load)
+
+        # a fleet connecting with one key parses it once
+        values = []
+        threads = [threading.Thread(target=lambda: values.append(cache.get(path))) for _ in range(8)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        assert values == ["key 1"] * 8 and len(n_loads) == 1, n_loads
+        print(f"8 concurrent connects: {elapsed * 1e3:.0f} ms, {len(n_loads)} load")
+
+        n_gets = 10_000
+        start = time.perf_counter()
+        for _ in range(n_gets):
+            cache.get(path)
+        print(f"cached get: {(time.perf_counter() - start) / n_gets * 1e6:.1f} us (a load takes 50 ms here)")
+
+        # a replaced key is loaded again
+        with open(path, "w") as f:
+            f.write("key 22")
+        assert cache.get(path) == "key 22" and len(n_loads) == 2
+
+        # a failed load is not cached
+        def fail(path):
+            raise ValueError("encrypted")
+        failing = ParsedFileCache(fail)
+        for _ in range(2):
+            try:
+                failing.get(path)
+            except ValueError:
+                pass
+            else:
+                assert False
+        print("ok")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
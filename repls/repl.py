@@ -43,6 +43,8 @@ class Repl(object):
         self.suppress_echo = suppress_echo
         self.additional_scopes = additional_scopes or []
         self.apiv2 = apiv2
+        # SessionRecorder given every byte read and written, set by ReplView
+        self.recorder = None
 
     def autocomplete_available(self):
         return False
@@ -63,6 +65,11 @@ class Repl(object):
         """Returns name of this repl that should be used as a filename"""
         return NotImplementedError
 
+    def connect(self):
+        """Called on the reader thread before the first read, override to
+           connect there instead of in __init__ on the UI thread"""
+        pass
+
     def is_alive(self):
         """ Returns true if the undelying process is stil working"""
         raise NotImplementedError
@@ -82,6 +89,8 @@ class Repl(object):
     def write(self, command):
         """Encodes and evaluates a given command"""
         (_bytes, how_many) = self.encoder(command)
+        if self.recorder is not None:
+            self.recorder.input(_bytes)
         return self.write_bytes(_bytes)
 
     def reset_decoder(self):
@@ -93,6 +102,8 @@ class Repl(object):
             bs = self.read_bytes()
             if not bs:
                 return None
+            if self.recorder is not None:
+                self.recorder.output(bs)
             try:
                 output = self.decoder.decode(bs)
             except Exception as e:
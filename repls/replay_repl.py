@@ -0,0 +1,55 @@
+import os
+import threading
+
+from .repl import Repl
+from ..session_recorder import read_session
+
+# longest pause replayed between two outputs, in recorded seconds
+REPLAY_MAX_IDLE = 2.0
+
+
+class ReplayRepl(Repl):
+    TYPE = "replay"
+
+    def __init__(self, encoding, path, speed=1.0, max_idle=REPLAY_MAX_IDLE, **kwds):
+        """Replays the output of a session recorded by SessionRecorder:
+        path: asciicast file to replay
+        speed: 1.0 keeps the recorded pace, 2.0 is twice as fast, 0 shows everything at once
+        max_idle: longer pauses are cut to this many seconds"""
+        super(ReplayRepl, self).__init__(encoding, **kwds)
+        self._path = path
+        self._speed = speed
+        self._max_idle = max_idle
+        self._events = read_session(path)
+        self._elapsed = 0
+        self._stop = threading.Event()
+        self._killed = False
+        self._alive = True
+
+    def name(self):
+        return os.path.basename(self._path)
+
+    def is_alive(self):
+        return self._alive
+
+    def read_bytes(self):
+        # typed input is not replayed, its echo is part of the output
+        for elapsed, kind, text in self._events:
+            if kind != "o":
+                continue
+            delay = min(elapsed - self._elapsed, self._max_idle)
+            self._elapsed = elapsed
+            if self._speed > 0 and delay > 0 and self._stop.wait(delay / self._speed):
+                break
+            (_bytes, how_many) = self.encoder(text)
+            return _bytes
+        self._alive = False
+        return None
+
+    def write_bytes(self, _bytes):
+        pass
+
+    def kill(self):
+        self._killed = True
+        self._alive = False
+        self._stop.set()
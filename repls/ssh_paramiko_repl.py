@@ -1,19 +1,70 @@
 import sublime
 import sublime_plugin
 
+import os
+import threading
+
 import paramiko
 
 from .repl import Repl
-from ..sublimerepl import TERMINAL_HEIGHT
+from ..sublimerepl import SETTINGS_FILE, TERMINAL_HEIGHT
 from ..ansi.ansi_regex import ANSI_ESCAPE_8BIT_REGEX_BYTES
 from .subprocess_repl import SubprocessRepl
+from .parsed_file_cache import ParsedFileCache
+from .ssh_transport_pool import SSH_POOL, SSH_POOL_IDLE_TIMEOUT, SSH_KEEPALIVE_INTERVAL
 from ..interceptor.interceptor import Interceptor
 
+# RSA, ECDSA and ed25519 private keys, by the type found in the file
+PRIVATE_KEYS = ParsedFileCache(paramiko.PKey.from_path)
+SSH_CONFIGS = ParsedFileCache(paramiko.SSHConfig.from_path)
+
+
+def ssh_host_config(ip):
+    """options of ssh_config_file for host ip, empty if there is no file"""
+    config_file = sublime.load_settings(SETTINGS_FILE).get("ssh_config_file", "~/.ssh/config")
+    if not config_file:
+        return {}
+    config_file = os.path.expanduser(config_file)
+    if not os.path.isfile(config_file):
+        return {}
+    return SSH_CONFIGS.get(config_file).lookup(ip)
+
+
+def connect_client(user, ip, key=None):
+    """returns a paramiko.SSHClient connected and authenticated with the
+       private key file key, else the IdentityFile of ssh_config_file, then
+       with the keys of the ssh-agent if ssh_allow_agent. HostName, Port,
+       User and ProxyCommand of ssh_config_file apply, timeouts are taken
+       from the settings"""
+    settings = sublime.load_settings(SETTINGS_FILE)
+    auth_timeout = settings.get("ssh_auth_timeout", 30)
+    allow_agent = settings.get("ssh_allow_agent", True)
+    host = ssh_host_config(ip)
+    if not key:
+        key = next((path for path in host.get("identityfile", []) if os.path.isfile(os.path.expanduser(path))), None)
+    pkey = None
+    if key:
+        try:
+            pkey = PRIVATE_KEYS.get(key)
+        except Exception as e:
+            # eg. a key with a passphrase, whose agent may hold it
+            if not allow_agent:
+                raise
+            print(f"SublimeREPL-ssh: cannot load {key} ({e!r}), trying the ssh-agent")
+    sock = paramiko.ProxyCommand(host["proxycommand"]) if "proxycommand" in host else None
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname=host.get("hostname", ip), port=int(host.get("port", 22)),
+                   username=user or host.get("user"), pkey=pkey, sock=sock, allow_agent=allow_agent,
+                   timeout=settings.get("ssh_connect_timeout", 10),
+                   banner_timeout=auth_timeout, auth_timeout=auth_timeout)
+    return client
+
 
 class SshParamikoRepl(SubprocessRepl):
     TYPE = "ssh_paramiko"
 
-    def __init__(self, encoding, user, ip, key, env=None, terminal_height=TERMINAL_HEIGHT, interceptor_handler=None, **kwds):
+    def __init__(self, encoding, ip, user=None, key=None, env=None, terminal_height=TERMINAL_HEIGHT, interceptor_handler=None, **kwds):
         Repl.__init__(self, encoding, **kwds)
         self._user = user
         self._ip = ip
@@ -21,19 +72,34 @@ class SshParamikoRepl(SubprocessRepl):
         self._env = env
         self._terminal_height = terminal_height
         self._interceptor_handler = interceptor_handler or Interceptor()
-        self._client = None
+        self._pool_key = (user, ip, key)
+        self._is_pooled = False
         self._transport = None
         self._channel = None
         self._alive = False
         self._killed = False
+        # input typed before the shell is open, sent once it is
+        self._connect_lock = threading.Lock()
+        self._pending_input = []
 
         self._ansi_escape_8bit = ANSI_ESCAPE_8BIT_REGEX_BYTES
         self._interceptor_handler.attach(self)
+
+    def _set_status(self, text):
+        rv = getattr(self, '_rv', None)
+        if rv is None:
+            return
+        if text:
+            rv._view.set_status('SublimeREPL-ssh', text)
+        else:
+            rv._view.erase_status('SublimeREPL-ssh')
+
+    def connect(self):
+        """Connects on the reader thread, so the view is usable meanwhile"""
         try:
-            sublime.active_window().active_view().set_status('SublimeREPL-ssh', f'connecting to {ip}')
             self._connect()
         finally:
-            sublime.active_window().active_view().erase_status('SublimeREPL-ssh')
+            self._set_status(None)
 
     def autocomplete_available(self):
         return False
@@ -47,60 +113,120 @@ class SshParamikoRepl(SubprocessRepl):
             return False
         return True
 
+    def _new_client(self):
+        self._set_status(f'connecting to {self._ip}')
+        return connect_client(self._user, self._ip, self._key)
+
     def _connect(self):
-        pkey = paramiko.RSAKey.from_private_key_file(self._key)
-        self._client = paramiko.SSHClient()
-        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self._client.connect(hostname=self._ip, username=self._user, pkey=pkey)
-        self._transport = self._client.get_transport()
-        self._killed = False
-        self._alive = self._check_alive()
-        if not self._alive:
+        """opens a shell channel on the pooled connection to the host,
+           connecting only if no other repl holds one"""
+        settings = sublime.load_settings(SETTINGS_FILE)
+        try:
+            pool_key, channel = SSH_POOL.open_channel(
+                self._pool_key, self._new_client, self._open_shell, refused=paramiko.ChannelException,
+                keepalive=settings.get("ssh_keepalive_interval", SSH_KEEPALIVE_INTERVAL))
+        except BaseException:
+            # input typed meanwhile is dropped, the view shows the error
+            with self._connect_lock:
+                self._pending_input = None
+            raise
+        with self._connect_lock:
+            self._pool_key = pool_key
+            self._channel = channel
+            self._is_pooled = True
+            if self._killed:
+                # closed while connecting
+                channel.close()
+                self._release()
+                return
+            self._alive = True
+            for _bytes in self._pending_input:
+                self._send(_bytes)
+            self._pending_input = None
+
+    def _open_shell(self, transport):
+        """called by the pool with the transport to open the shell on"""
+        self._set_status(f'opening shell on {self._ip}')
+        self._transport = transport
+        if not self._check_alive():
             raise RuntimeError(f"ssh_paramiko could not connect to {self._ip}")
-        self._connect_channel()
-
-    def _connect_channel(self):
-        self._channel = self._transport.open_session()
-        if self._env:
-            self._channel.update_environment(self._env)
-        self._channel.get_pty(height=self._terminal_height)
-        self._channel.invoke_shell()
+        channel = transport.open_session()
+        try:
+            if self._env:
+                channel.update_environment(self._env)
+            channel.get_pty(height=self._terminal_height)
+            channel.invoke_shell()
+        except BaseException:
+            channel.close()
+            raise
+        return channel
 
     def name(self):
-        return f'{self._user}@{self._ip}'
+        return f'{self._user}@{self._ip}' if self._user else self._ip
 
     def is_alive(self):
         # self._alive = self._check_alive()
         return self._alive
 
     def _read(self):
+        if self._channel is None:
+            # killed before the shell was open
+            return b''
         _bytes = self._channel.recv(self._read_buffer)
         return _bytes
 
-    def _write_bytes(self, _bytes):
+    def _send(self, _bytes):
+        if self._channel is None:
+            # the shell could not be opened
+            return
         try:
             self._channel.sendall(_bytes)
         except paramiko.SSHException:
             self._alive = False
 
+    def _write_bytes(self, _bytes):
+        # the interceptor replaces write_bytes and calls this directly
+        if self._pending_input is not None:
+            with self._connect_lock:
+                if self._pending_input is not None:
+                    self._pending_input.append(_bytes)
+                    return
+        self._send(_bytes)
+
     def write_bytes(self, _bytes):
         self._write_bytes(_bytes)
 
+    def _release(self):
+        """hands the connection back to the pool, other repls to the host
+           keep using it"""
+        if not self._is_pooled:
+            return
+        self._is_pooled = False
+        idle_timeout = sublime.load_settings(SETTINGS_FILE).get("ssh_pool_idle_timeout", SSH_POOL_IDLE_TIMEOUT)
+        SSH_POOL.release(self._pool_key, idle_timeout=idle_timeout)
+
+    def open_sftp(self):
+        """context manager yielding the SFTP session shared by every repl
+           to this host"""
+        return SSH_POOL.sftp(self._pool_key)
+
+    def close(self):
+        # is_alive() is False while connecting, kill anyway so the connect
+        # gives up its shell and pool reference once it completes
+        with self._connect_lock:
+            killed = self._killed
+        if not killed:
+            self.kill()
+
     def kill(self):
-        self._killed = True
-        self._alive = False
-        try:
-            self._channel.close()
-        except:
-            pass
-        try:
-            self._transport.close()
-        except:
-            pass
-        try:
-            self._client.close()
-        except:
-            pass
+        with self._connect_lock:
+            self._killed = True
+            self._alive = False
+            try:
+                self._channel.close()
+            except:
+                pass
+            self._release()
 
     def send_signal(self, sig):
         self._rv.clear_queue()
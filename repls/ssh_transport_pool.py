@@ -0,0 +1,276 @@
+import contextlib
+import threading
+import time
+
+# seconds an unused connection is kept open for the next repl to the host
+SSH_POOL_IDLE_TIMEOUT = 60.0
+# seconds between keepalive packets on pooled connections, 0 disables them
+SSH_KEEPALIVE_INTERVAL = 30
+# connections opened to one (user, host, key) when the server refuses more
+# channels on each, see MaxSessions in sshd_config
+SSH_POOL_MAX_CONNECTIONS = 8
+
+
+class _PoolEntry:
+    def __init__(self):
+        self.lock = threading.Lock()  # held while connecting
+        self.client = None
+        self.refs = 0
+        self.idle_since = None
+        self.sftp = None
+        self.sftp_lock = threading.Lock()
+
+
+class SshTransportPool:
+    """Authenticated ssh connections shared by every repl to the same
+    (user, host, key).
+
+    The first repl to a host connects, later ones open a shell channel on
+    the same transport, so they skip the TCP connect, key exchange and
+    auth. Connections are reference counted: one no repl uses is closed
+    after idle_timeout, unless a repl to that host is opened meanwhile.
+    Connects to different hosts run in parallel, concurrent repls to one
+    host wait for a single connect.
+    connect() must return a connected paramiko.SSHClient."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # (user, host, key): _PoolEntry
+
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _PoolEntry()
+            entry.refs += 1
+            entry.idle_since = None
+            return entry
+
+    def acquire(self, key, connect, keepalive=SSH_KEEPALIVE_INTERVAL):
+        """returns the transport for key, connecting if it has none alive"""
+        entry = self._entry(key)
+        try:
+            with entry.lock:
+                transport = entry.client.get_transport() if entry.client is not None else None
+                if transport is None or not transport.is_active():
+                    if entry.client is not None:
+                        entry.client.close()
+                    entry.client = None
+                    entry.sftp = None
+                    client = connect()
+                    transport = client.get_transport()
+                    if keepalive:
+                        transport.set_keepalive(keepalive)
+                    entry.client = client
+                return transport
+        except BaseException:
+            self.release(key, idle_timeout=0)
+            raise
+
+    def open_channel(self, key, connect, open_channel, refused=(), keepalive=SSH_KEEPALIVE_INTERVAL):
+        """Returns (pool key, channel) of a channel opened by
+           open_channel(transport) on the connection for key, holding a
+           reference to be released with that pool key. A connection whose
+           server refuses the channel with one of the refused exceptions,
+           once MaxSessions channels are open on it, is passed over for a
+           further connection to the host."""
+        for n in range(SSH_POOL_MAX_CONNECTIONS):
+            slot_key = key if n == 0 else key + (n,)
+            connected = []
+
+            def connect_slot():
+                client = connect()
+                connected.append(True)
+                return client
+            transport = self.acquire(slot_key, connect_slot, keepalive=keepalive)
+            try:
+                return slot_key, open_channel(transport)
+            except refused:
+                self.release(slot_key, idle_timeout=0)
+                if connected:
+                    # refused on a connection of its own, not for MaxSessions
+                    raise
+            except BaseException:
+                self.release(slot_key, idle_timeout=0)
+                raise
+        raise RuntimeError(f"{key[0]}@{key[1]} refused a channel on {SSH_POOL_MAX_CONNECTIONS} connections")
+
+    def release(self, key, idle_timeout=SSH_POOL_IDLE_TIMEOUT):
+        """drops a reference taken by acquire"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs > 0:
+                return
+            if idle_timeout <= 0:
+                self._close(key, entry)
+                return
+            idle_since = entry.idle_since = time.monotonic()
+        timer = threading.Timer(idle_timeout, self._expire, (key, idle_since))
+        timer.daemon = True
+        timer.start()
+
+    def _expire(self, key, idle_since):
+        with self._lock:
+            entry = self._entries.get(key)
+            # still unused since that release
+            if entry is not None and entry.refs == 0 and entry.idle_since == idle_since:
+                self._close(key, entry)
+
+    def _close(self, key, entry):
+        del self._entries[key]
+        if entry.client is not None:
+            try:
+                entry.client.close()
+            except Exception as e:
+                print(e)
+
+    @contextlib.contextmanager
+    def sftp(self, key):
+        """yields the SFTP session kept on the connection for key, one
+           operation at a time"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry.client is None:
+            raise RuntimeError(f"no ssh connection to {key[0]}@{key[1]}")
+        with entry.sftp_lock:
+            if entry.sftp is None or entry.sftp.get_channel().closed:
+                entry.sftp = entry.client.open_sftp()
+            yield entry.sftp
+
+    def close_all(self):
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                self._close(key, entry)
+
+
+SSH_POOL = SshTransportPool()
+
+
+"""
+headless check with fake clients, run with:
+    python repls/ssh_transport_pool.py
+"""
+
+def main():
+    class FakeChannel:
+        closed = False
+
+    class FakeTransport:
+        def __init__(self):
+            self.active = True
+            self.keepalive = None
+
+        def is_active(self):
+            return self.active
+
+        def set_keepalive(self, interval):
+            self.keepalive = interval
+
+    class FakeClient:
+        n_connects = 0
+
+        def __init__(self):
+            time.sleep(0.2)  # key exchange and auth
+            FakeClient.n_connects += 1
+            self.transport = FakeTransport()
+            self.closed = False
+
+        def get_transport(self):
+            return self.transport
+
+        def open_sftp(self):
+            sftp = type("FakeSftp", (), {})()
+            sftp.get_channel = FakeChannel
+            return sftp
+
+        def close(self):
+            self.closed = True
+            self.transport.active = False
+
+    pool = SshTransportPool()
+    key = ("root", "10.0.0.1", "id_rsa")
+
+    # five tabs to one host at once share a single connect
+    transports = []
+    threads = [threading.Thread(target=lambda: transports.append(pool.acquire(key, FakeClient, keepalive=15)))
+               for _ in range(5)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    assert FakeClient.n_connects == 1 and len(set(map(id, transports))) == 1, FakeClient.n_connects
+    assert transports[0].keepalive == 15
+    print(f"5 repls to one host: {elapsed * 1e3:.0f} ms, {FakeClient.n_connects} connect")
+
+    # an extra tab to a connected host takes no connect
+    start = time.perf_counter()
+    pool.acquire(key, FakeClient)
+    print(f"extra repl to a connected host: {(time.perf_counter() - start) * 1e3:.3f} ms")
+    with pool.sftp(key) as sftp_a:
+        pass
+    with pool.sftp(key) as sftp_b:
+        assert sftp_a is sftp_b
+
+    # kept while in use or within the idle timeout, closed after it
+    for _ in range(6):
+        pool.release(key, idle_timeout=0.1)
+    client = pool._entries[key].client
+    pool.acquire(key, FakeClient)
+    time.sleep(0.2)
+    assert FakeClient.n_connects == 1 and not client.closed
+    pool.release(key, idle_timeout=0.1)
+    time.sleep(0.2)
+    assert client.closed and key not in pool._entries
+
+    # a dead connection is replaced
+    transport = pool.acquire(key, FakeClient)
+    transport.active = False
+    assert pool.acquire(key, FakeClient) is not transport and FakeClient.n_connects == 3
+
+    # channels past MaxSessions go to a further connection
+    class Refused(Exception):
+        pass
+
+    def open_channel(transport):
+        transport.n_channels = getattr(transport, "n_channels", 0) + 1
+        if transport.n_channels > 2:
+            raise Refused()
+        return object()
+    host = ("root", "10.0.0.3", "id_rsa")
+    n_connects = FakeClient.n_connects
+    slot_keys = [pool.open_channel(host, FakeClient, open_channel, refused=Refused)[0] for _ in range(5)]
+    assert slot_keys == [host, host, host + (1,), host + (1,), host + (2,)], slot_keys
+    assert FakeClient.n_connects == n_connects + 3
+    assert pool._entries[host].refs == 2 and pool._entries[host + (2,)].refs == 1
+
+    # a connection of its own refusing is an error
+    def refuse(transport):
+        raise Refused()
+    try:
+        pool.open_channel(("root", "10.0.0.4", "id_rsa"), FakeClient, refuse, refused=Refused)
+    except Refused:
+        pass
+    else:
+        assert False
+    assert ("root", "10.0.0.4", "id_rsa") not in pool._entries
+
+    # a failed connect drops the reference it took
+    def fail():
+        raise OSError("refused")
+    other = ("root", "10.0.0.2", "id_rsa")
+    try:
+        pool.acquire(other, fail)
+    except OSError:
+        pass
+    assert other not in pool._entries
+    pool.close_all()
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,16 @@ import sublime
 import sublime_plugin
 
 from .ansi.ansi_color_utils import ANSI_COLOR_DIR
+from .sublimerepl import SCROLLBACK_ARCHIVE_DIR, HISTORY_DIR
+from .repl_history import migrate_history_dir
+from .date_and_type_logger import stop_date_and_type_loggers
+from .repls.ssh_transport_pool import SSH_POOL
+from .repl_broadcast import BROADCASTER
 
 SUBLIMEREPL_DIR = None
 SUBLIMEREPL_USER_DIR = None
 
-def _cleanup_ansi():
+def _open_repl_ids():
     repl_ids = []
     for window in sublime.windows():
         views = window.views()
@@ -20,14 +25,41 @@ def _cleanup_ansi():
             if not repl_id:
                 continue
             repl_ids.append(repl_id)
-    color_dir = os.path.join(sublime.packages_path(), ANSI_COLOR_DIR).replace('\\', '/')
-    files = [f for f in os.listdir(color_dir)]
-    for file_name in files:
-        filetitle = os.path.splitext(file_name)[0]
-        if filetitle not in repl_ids:
-            file_path = os.path.join(color_dir, file_name)
+    return repl_ids
+
+
+def _cleanup_ansi():
+    """Removes generated colour schemes no open view is drawn with, including
+       the per repl schemes older versions wrote to the user dir"""
+    in_use = set()
+    for window in sublime.windows():
+        for view in window.views():
+            in_use.add(os.path.basename(view.settings().get('color_scheme') or ''))
+    color_dirs = (
+        SUBLIMEREPL_USER_DIR,
+        os.path.join(sublime.packages_path(), ANSI_COLOR_DIR),
+    )
+    for color_dir in color_dirs:
+        if not os.path.isdir(color_dir):
+            continue
+        for file_name in os.listdir(color_dir):
+            if not file_name.endswith('.sublime-color-scheme') or file_name in in_use:
+                continue
             try:
-                os.remove(file_path)
+                os.remove(os.path.join(color_dir, file_name))
+            except Exception as e:
+                print(e)
+
+
+def _cleanup_scrollback():
+    repl_ids = _open_repl_ids()
+    scrollback_dir = os.path.join(sublime.packages_path(), SCROLLBACK_ARCHIVE_DIR)
+    if not os.path.isdir(scrollback_dir):
+        return
+    for file_name in os.listdir(scrollback_dir):
+        if file_name.split('.')[0] not in repl_ids:
+            try:
+                os.remove(os.path.join(scrollback_dir, file_name))
             except Exception as e:
                 print(e)
 
@@ -40,6 +72,16 @@ def plugin_loaded():
     if not os.path.exists(SUBLIMEREPL_USER_DIR):
         os.makedirs(SUBLIMEREPL_USER_DIR, exist_ok=True)
     _cleanup_ansi()
+    _cleanup_scrollback()
+    history_dir = os.path.join(sublime.packages_path(), HISTORY_DIR)
+    sublime.set_timeout_async(lambda: migrate_history_dir(history_dir), 0)
+
+
+def plugin_unloaded():
+    # write out queued input logs before the plugin is reloaded
+    stop_date_and_type_loggers()
+    SSH_POOL.close_all()
+    BROADCASTER.close()
 
 PY2 = False
 if sys.version_info[0] == 2:
@@ -0,0 +1,163 @@
+import codecs
+import collections
+import json
+import os
+import threading
+import time
+
+# bytes waiting to be written before the repl waits for the disk
+SESSION_BUFFER_BYTES = 4 * 1024 * 1024
+
+
+class SessionRecorder:
+    """Records a repl session as an asciicast v2 file, which asciinema can
+    play as well as the replay repl.
+
+    Bytes read from the repl, and written to it if record_input, are
+    queued with the time they were seen, and a background thread decodes
+    and writes them, flushing once per batch. No frame is dropped: once
+    buffer_bytes are waiting, the repl waits for the writer to catch up,
+    so a frame never loses half an escape sequence or character.
+    Typed input includes passwords entered at prompts, so it is only
+    recorded if asked for."""
+
+    def __init__(self, path, encoding="utf-8", width=80, height=24, title=None, record_input=False,
+                 buffer_bytes=SESSION_BUFFER_BYTES):
+        self.path = path
+        self._record_input = record_input
+        self._buffer_bytes = buffer_bytes
+        self._cond = threading.Condition()
+        self._frames = collections.deque()
+        self._n_bytes = 0
+        self._start = time.monotonic()
+        self._decoders = {
+            "o": codecs.getincrementaldecoder(encoding)(errors="replace"),
+            "i": codecs.getincrementaldecoder(encoding)(errors="replace"),
+        }
+        header = {
+            "version": 2,
+            "width": width,
+            "height": height,
+            "timestamp": int(time.time()),
+            "env": {"TERM": "xterm-256color"},
+        }
+        if title:
+            header["title"] = title
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "w", encoding="utf-8", newline="\n")
+        self._file.write(json.dumps(header) + "\n")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def output(self, _bytes):
+        self._put(("o", _bytes))
+
+    def input(self, _bytes):
+        if self._record_input:
+            self._put(("i", _bytes))
+
+    def _put(self, frame):
+        with self._cond:
+            while self._n_bytes >= self._buffer_bytes:
+                self._cond.wait()
+            if frame is not None:
+                frame = (time.monotonic() - self._start,) + frame
+                self._n_bytes += len(frame[2])
+            self._frames.append(frame)
+            self._cond.notify_all()
+
+    def close(self):
+        """stops recording once the queued frames are written"""
+        self._put(None)
+
+    def _run(self):
+        f = self._file
+        try:
+            while True:
+                with self._cond:
+                    while not self._frames:
+                        self._cond.wait()
+                    frames = self._frames
+                    self._frames = collections.deque()
+                    self._n_bytes = 0
+                    self._cond.notify_all()
+                for frame in frames:
+                    if frame is None:
+                        return
+                    self._write_frame(*frame)
+                f.flush()
+        finally:
+            f.close()
+
+    def _write_frame(self, elapsed, kind, _bytes):
+        text = self._decoders[kind].decode(_bytes)
+        if text:
+            self._file.write(json.dumps([round(elapsed, 6), kind, text], ensure_ascii=False) + "\n")
+
+
+def read_session(path):
+    """yields (elapsed, kind, text) of every event recorded in path, lines
+       torn by a crash are skipped"""
+    with open(path, "r", encoding="utf-8") as f:
+        f.readline()  # header
+        for line in f:
+            try:
+                elapsed, kind, text = json.loads(line)
+            except ValueError:
+                continue
+            yield elapsed, kind, text
+
+
+"""
+headless benchmark, run with:
+    python session_recorder.py
+"""
+
+def main():
+    import shutil
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "session.cast")
+        recorder = SessionRecorder(path, title="root@10.0.0.1", record_input=True)
+        recorder.input(b"ls\n")
+        # a character split between reads is decoded whole
+        recorder.output("café \x1b[1;31mred\x1b[0m\n".encode("utf-8")[:4])
+        recorder.output("café \x1b[1;31mred\x1b[0m\n".encode("utf-8")[4:])
+        recorder.close()
+        recorder._thread.join()
+        events = list(read_session(path))
+        assert [(kind, text) for _, kind, text in events] == [
+            ("i", "ls\n"), ("o", "caf"), ("o", "é \x1b[1;31mred\x1b[0m\n")], events
+
+        # input is left out unless asked for
+        recorder = SessionRecorder(path)
+        recorder.input(b"hunter2\n")
+        recorder.output(b"$ ")
+        recorder.close()
+        recorder._thread.join()
+        assert [kind for _, kind, _ in read_session(path)] == ["o"]
+
+        # time spent in output() per packet, which the repl reader waits
+        # for, and every packet is written
+        n_packets = 100_000
+        packet = b"drwxr-xr-x 2 root root 4096 Jan  1 00:00 \x1b[01;34mlog\x1b[0m\n" * 20
+        recorder = SessionRecorder(os.path.join(tmp_dir, "bench.cast"))
+        start = time.perf_counter()
+        for _ in range(n_packets):
+            recorder.output(packet)
+        elapsed = time.perf_counter() - start
+        recorder.close()
+        recorder._thread.join()
+        n_written = sum(1 for _, kind, _ in read_session(recorder.path) if kind == "o")
+        print(f"{n_packets} packets of {len(packet)} bytes: {elapsed / n_packets * 1e6:.2f} us/packet, "
+              f"{n_written} written")
+        assert n_written == n_packets, n_written
+        print("ok")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
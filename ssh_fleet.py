@@ -0,0 +1,157 @@
+import sublime
+import sublime_plugin
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import SETTINGS_FILE, CAN_USE_PARAMIKO
+from .repl_manager_init import manager
+
+FLEET_PANEL = "repl_fleet"
+# a connection made for the fleet is kept at least this long for its view
+FLEET_HANDOFF_TIMEOUT = 10.0
+
+
+def read_inventory(path):
+    """hosts listed in path, either a JSON list or one [user@]host per line
+       with # starting a comment"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    hosts = []
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line:
+            hosts.append(line)
+    return hosts
+
+
+def fleet_entry(host, defaults):
+    """repl_open args for host, given as "user@ip", "ip" or a dict of args
+       overriding defaults"""
+    entry = dict(defaults)
+    if isinstance(host, dict):
+        entry.update(host)
+    else:
+        user, _, ip = host.rpartition("@")
+        entry["ip"] = ip
+        if user:
+            entry["user"] = user
+    if entry.get("key"):
+        entry["key"] = os.path.expanduser(entry["key"])
+    entry.setdefault("title", entry["ip"])
+    entry.setdefault("encoding", "utf-8")
+    entry.pop("type", None)
+    return entry
+
+
+class FleetPanel:
+    def __init__(self, window):
+        self._panel = window.create_output_panel(FLEET_PANEL)
+        window.run_command("show_panel", {"panel": "output." + FLEET_PANEL})
+
+    def append(self, text):
+        self._panel.run_command("append", {"characters": text + "\n", "force": True, "scroll_to_end": True})
+
+
+class _FleetConnect:
+    """Connects entries on a bounded thread pool and opens a view for each
+    as soon as its connect completes. The connection is made through the
+    ssh transport pool, so the view's repl opens its shell on it at once."""
+
+    def __init__(self, window, panel, entries, workers):
+        self._window = window
+        self._panel = panel
+        self._entries = entries
+        self._workers = workers
+        self._n_left = len(entries)
+        self._n_failed = 0
+        self._slowest = (0, None)
+        self._start = time.monotonic()
+
+    def start(self):
+        # paramiko is only importable where CAN_USE_PARAMIKO
+        from .repls.ssh_paramiko_repl import connect_client
+        from .repls.ssh_transport_pool import SSH_POOL, SSH_KEEPALIVE_INTERVAL, SSH_POOL_IDLE_TIMEOUT
+        settings = sublime.load_settings(SETTINGS_FILE)
+        self._pool = SSH_POOL
+        self._keepalive = settings.get("ssh_keepalive_interval", SSH_KEEPALIVE_INTERVAL)
+        self._idle_timeout = max(settings.get("ssh_pool_idle_timeout", SSH_POOL_IDLE_TIMEOUT), FLEET_HANDOFF_TIMEOUT)
+        executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="repl_fleet")
+        for entry in self._entries:
+            future = executor.submit(self._connect, entry, connect_client)
+            future.add_done_callback(lambda future, entry=entry: sublime.set_timeout(
+                lambda: self._on_connected(entry, *future.result()), 0))
+        executor.shutdown(wait=False)
+
+    @staticmethod
+    def _pool_key(entry):
+        return (entry.get("user"), entry["ip"], entry.get("key"))
+
+    def _connect(self, entry, connect_client):
+        """runs on a worker, returns (seconds, exception or None)"""
+        start = time.monotonic()
+        key = self._pool_key(entry)
+        try:
+            self._pool.acquire(key, lambda: connect_client(*key), keepalive=self._keepalive)
+        except Exception as e:
+            return time.monotonic() - start, e
+        return time.monotonic() - start, None
+
+    def _on_connected(self, entry, elapsed, error):
+        name = "%s@%s" % (entry["user"], entry["ip"]) if entry.get("user") else entry["ip"]
+        if error is None:
+            rv = manager.open(self._window, type="ssh_paramiko", show_error=False, **entry)
+            # the view's repl holds its own reference once it has connected
+            self._pool.release(self._pool_key(entry), idle_timeout=self._idle_timeout)
+            if rv is None:
+                error = "could not open view"
+        if error is None:
+            self._panel.append("  ok   %6.2fs  %s" % (elapsed, name))
+            if elapsed > self._slowest[0]:
+                self._slowest = (elapsed, name)
+        else:
+            self._n_failed += 1
+            self._panel.append("  FAIL %6.2fs  %s: %s" % (elapsed, name, error))
+        self._n_left -= 1
+        if self._n_left:
+            return
+        n_hosts = len(self._entries)
+        self._panel.append("%d/%d connected, %d failed, in %.2fs (slowest %.2fs %s)" % (
+            n_hosts - self._n_failed, n_hosts, self._n_failed, time.monotonic() - self._start,
+            self._slowest[0], self._slowest[1] or "-"))
+
+
+class ReplOpenFleetCommand(sublime_plugin.WindowCommand):
+    """Opens a paramiko repl to every host of an inventory: hosts if given,
+    else the hosts listed in file, else ssh_fleet_hosts. Hosts are connected
+    ssh_fleet_workers at a time, timings and failures are listed in an
+    output panel."""
+
+    def run(self, hosts=None, file=None, workers=None):
+        settings = sublime.load_settings(SETTINGS_FILE)
+        if file is not None:
+            try:
+                hosts = read_inventory(os.path.expanduser(file))
+            except (OSError, ValueError) as e:
+                sublime.error_message("Cannot read host inventory %s: %s" % (file, e))
+                return
+        elif hosts is None:
+            hosts = settings.get("ssh_fleet_hosts", [])
+        if not hosts:
+            sublime.status_message("no hosts, set ssh_fleet_hosts or pass hosts or file")
+            return
+        defaults = settings.get("ssh_fleet_defaults", {})
+        entries = [fleet_entry(host, defaults) for host in hosts]
+        workers = workers or settings.get("ssh_fleet_workers", 8)
+        panel = FleetPanel(self.window)
+        if not (CAN_USE_PARAMIKO and settings.get("use_paramiko", False)):
+            panel.append("opening %d hosts with openssh, connect timings are not available" % (len(entries),))
+            for entry in entries:
+                manager.open(self.window, type="ssh_paramiko", **entry)
+            return
+        panel.append("connecting %d hosts, %d at a time" % (len(entries), workers))
+        _FleetConnect(self.window, panel, entries, workers).start()
@@ -4,11 +4,13 @@
 # See LICENSE.txt for details.
 from __future__ import absolute_import, unicode_literals, print_function, division
 
+import gzip
+from itertools import islice
 import os
 import os.path
+import re
 import threading
-from datetime import datetime
-from time import sleep
+import time
 
 import sublime
 import sublime_plugin
@@ -17,14 +19,17 @@ try:
     import queue
     from .ansi import ansi_control, ansi_color_utils
     from .ansi.ansi_regex import ANSI_ESCAPE_8BIT_REGEX, ANSI_COLOR_REGEX
-    from .repllibs import PyDbLite
+    from .ansi.ansi_tokenizer import split_incomplete_escape
 except ImportError:
     import Queue as queue
     from ansi import ansi_control, ansi_color_utils
     from ansi.ansi_regex import ANSI_ESCAPE_8BIT_REGEX, ANSI_COLOR_REGEX
-    from repllibs import PyDbLite
+    from ansi.ansi_tokenizer import split_incomplete_escape
 from . import SETTINGS_FILE
 from .date_and_type_logger import get_date_and_type_logger
+from .repl_view_updater import FRAME_IDLE, FRAME_MORE, ReplViewUpdater, drain_frame, drain_queue
+from .repl_history import BackgroundSearchIndex, HistoryIndex, get_history_store, history_path, merged_commands, migrate_pydblite, seed_partition
+from .session_recorder import SessionRecorder
 
 # import importlib; importlib.reload(repls.subprocess_repl);
 # import importlib; importlib.reload(ansi_control);
@@ -35,6 +40,15 @@ SUBLIME2 = sublime.version() < '3000'
 # READ_BUFFER = 8192
 READ_BUFFER = 32_768
 TERMINAL_HEIGHT = 24 # default
+# scrollback is allowed to overshoot its limit by this fraction before
+# being trimmed, so the head of the view is erased in large batches
+SCROLLBACK_TRIM_SLACK = 0.1
+SCROLLBACK_ARCHIVE_DIR = os.path.join("User", "SublimeREPL-ssh", "scrollback")
+HISTORY_DIR = os.path.join("User", ".SublimeREPLHistory")
+SESSION_DIR = os.path.join("User", "SublimeREPL-ssh", "sessions")
+
+# one shared worker drains output for every ReplView
+VIEW_UPDATER = ReplViewUpdater()
 
 
 class ReplInsertTextCommand(sublime_plugin.TextCommand):
@@ -49,6 +63,12 @@ class ReplEraseTextCommand(sublime_plugin.TextCommand):
         self.view.erase(edit, sublime.Region(int(start), int(end)))
 
 
+class ReplReplaceTextCommand(sublime_plugin.TextCommand):
+    def run(self, edit, start, end, text):
+        self.view.set_read_only(False)  # make sure view is writable
+        self.view.replace(edit, sublime.Region(int(start), int(end)), text)
+
+
 class ReplPass(sublime_plugin.TextCommand):
     def run(self, edit):
         pass
@@ -60,40 +80,78 @@ class ReplReader(threading.Thread):
         self.repl = repl
         self.daemon = True
         self.queue = queue.Queue()
+        # callable() invoked after every queued packet, set by ReplView
+        self.on_output = None
+        self.finished = False
+        # exception raised by repl.connect(), nothing is read after it
+        self.connect_error = None
+
+    def _notify(self):
+        on_output = self.on_output
+        if on_output is not None:
+            on_output()
 
     def run(self):
         r = self.repl
         q = self.queue
-        while True:
-            result = r.read()
-            q.put(result)
-            if result is None:
-                break
+        try:
+            try:
+                r.connect()
+            except Exception as e:
+                self.connect_error = e
+                return
+            while True:
+                result = r.read()
+                q.put(result)
+                if result is None:
+                    break
+                self._notify()
+        finally:
+            self.finished = True
+            self._notify()
 
 
 class HistoryMatchList(object):
-    def __init__(self, command_prefix, commands):
+    """Cursor over the commands matching a prefix, walked from the newest.
+    matches is an iterator yielding them newest first, it is read a page
+    at a time as the cursor moves back."""
+
+    PAGE_SIZE = 32
+
+    def __init__(self, command_prefix, matches):
         self._command_prefix = command_prefix
-        self._commands = commands
-        self._cur = len(commands)  # no '-1' on purpose
+        self._matches = matches
+        self._commands = []  # fetched so far, newest first
+        self._cur = -1  # no match selected yet
+
+    def _fetch(self, n):
+        """reads pages until n commands are fetched or matches run out"""
+        while self._matches is not None and len(self._commands) < n:
+            page = list(islice(self._matches, self.PAGE_SIZE))
+            self._commands.extend(page)
+            if len(page) < self.PAGE_SIZE:
+                self._matches = None
 
     def current_command(self):
-        if not self._commands:
+        if self._cur < 0 or not self._commands:
             return ""
         return self._commands[self._cur]
 
     def prev_command(self):
-        self._cur = max(0, self._cur - 1)
+        self._fetch(self._cur + 2)
+        self._cur = min(len(self._commands) - 1, self._cur + 1)
         return self.current_command()
 
     def next_command(self):
-        self._cur = min(len(self._commands) - 1, self._cur + 1)
+        self._fetch(1)
+        self._cur = max(0, self._cur - 1)
         return self.current_command()
 
 
 class History(object):
-    def __init__(self):
+    def __init__(self, dedupe=False):
         self._last = None
+        self._dedupe = dedupe
 
     def push(self, command):
         cmd = command.rstrip()
@@ -108,41 +166,63 @@ class History(object):
     def match(self, command_prefix):
         raise NotImplementedError()
 
+    def search(self, query, limit=None):
+        raise NotImplementedError()
+
 
 class MemHistory(History):
-    def __init__(self):
-        super(MemHistory, self).__init__()
-        self._stack = []
+    def __init__(self, dedupe=False):
+        super(MemHistory, self).__init__(dedupe)
+        self._index = HistoryIndex()
+        self._commands = []
+        self._search_index = BackgroundSearchIndex(self._commands)
 
     def append(self, cmd):
-        self._stack.append(cmd)
+        self._index.add(cmd)
+        self._commands.append(cmd)
 
     def match(self, command_prefix):
-        matching_commands = []
-        for cmd in self._stack:
-            if cmd.startswith(command_prefix):
-                matching_commands.append(cmd)
-        return HistoryMatchList(command_prefix, matching_commands)
+        return HistoryMatchList(command_prefix, self._index.iter_matches(command_prefix, self._dedupe))
+
+    def search(self, query, limit=None):
+        return self._search_index.search(query, limit)
 
 
 class PersistentHistory(MemHistory):
-    def __init__(self, external_id):
-        super(PersistentHistory, self).__init__()
-        path = os.path.join(sublime.packages_path(), "User", ".SublimeREPLHistory")
-        if not os.path.isdir(path):
-            os.makedirs(path)
-        filepath = os.path.join(path, external_id + ".db")
-        self._db = PyDbLite.Base(filepath)
+    """History stored per external_id, or per host (user@ip) of an ssh repl
+    if given. With merge_hosts recall also covers every other host of the
+    same external_id, as they were when the view was opened."""
+
+    def __init__(self, external_id, max_entries=0, dedupe=False, host=None, merge_hosts=False):
+        super(PersistentHistory, self).__init__(dedupe)
+        path = os.path.join(sublime.packages_path(), HISTORY_DIR)
+        try:
+            migrate_pydblite(os.path.join(path, external_id + ".db"), history_path(path, external_id))
+            if host is not None:
+                seed_partition(path, external_id, host)
+        except Exception as e:
+            print(e)
+        self._store = get_history_store(history_path(path, external_id, host), max_entries)
         self._external_id = external_id
-        self._db.create("external_id", "command", "ts", mode="open")
+        self._merged = merge_hosts and host is not None
+        if self._merged:
+            for cmd in merged_commands(path, external_id):
+                super(PersistentHistory, self).append(cmd)
 
     def append(self, cmd):
-        self._db.insert(external_id=self._external_id, command=cmd, ts=datetime.now())
-        self._db.commit()
+        self._store.append(cmd)
+        if self._merged:
+            super(PersistentHistory, self).append(cmd)
 
     def match(self, command_prefix):
-        retults = [cmd for cmd in self._db if cmd["command"].startswith(command_prefix)]
-        return HistoryMatchList(command_prefix, [x["command"] for x in retults])
+        if self._merged:
+            return super(PersistentHistory, self).match(command_prefix)
+        return HistoryMatchList(command_prefix, self._store.index.iter_matches(command_prefix, self._dedupe))
+
+    def search(self, query, limit=None):
+        if self._merged:
+            return super(PersistentHistory, self).search(query, limit)
+        return self._store.search_index.search(query, limit)
 
 
 class ReplView(object):
@@ -155,6 +235,8 @@ class ReplView(object):
         self._repl_launch_args = repl_restart_args
         # list of callable(repl) to handle view close events
         self.call_on_close = []
+        # list of callable(repl_view, text) seeing all output written to the view
+        self.output_listeners = []
         self._read_buffer = READ_BUFFER
 
         if syntax:
@@ -163,7 +245,6 @@ class ReplView(object):
         self._prompt_size = 0
 
         self._repl_reader = ReplReader(repl)
-        self._repl_reader.start()
 
         self._repl_title = title
         self._repl_ip = ip
@@ -187,16 +268,35 @@ class ReplView(object):
 
         view.settings().set("history_arrows", settings.get("history_arrows", True))
 
+        history_dedupe = settings.get("history_deduplicate", False)
         # for hysterical rasins ;)
         persistent_history_enabled = settings.get("persistent_history_enabled") or settings.get("presistent_history_enabled")
         if self.external_id and persistent_history_enabled:
-            self._history = PersistentHistory(self.external_id)
+            host = None
+            if self._repl_ip and settings.get("persistent_history_per_host", True):
+                host = self.host_name
+            self._history = PersistentHistory(self.external_id, settings.get("persistent_history_max_entries", 0),
+                                              dedupe=history_dedupe, host=host,
+                                              merge_hosts=settings.get("persistent_history_merge_hosts", False))
         else:
-            self._history = MemHistory()
+            self._history = MemHistory(dedupe=history_dedupe)
         self._history_match = None
 
         self._view_auto_close = settings.get("view_auto_close")
 
+        output_fps = settings.get("output_fps", 60)
+        self._frame_interval = 1.0 / output_fps if output_fps else 0
+        self._last_frame = 0
+        self._is_frame_scheduled = False
+        self._is_frame_dirty = False
+
+        self._max_scrollback_lines = settings.get("max_scrollback_lines", 0)
+        self._max_scrollback_bytes = settings.get("max_scrollback_bytes", 0)
+        self._scrollback_archive = None
+        if (self._max_scrollback_lines or self._max_scrollback_bytes) and settings.get("scrollback_archive"):
+            self._scrollback_archive = os.path.join(sublime.packages_path(), SCROLLBACK_ARCHIVE_DIR, repl.id + ".txt.gz")
+            view.settings().set("repl_scrollback_archive", self._scrollback_archive)
+
         self._log_input = settings.get("log_input")
         self._separate_logs_per_server = settings.get("separate_logs_per_server")
         if self._log_input and 'ssh' not in self.repl.TYPE:
@@ -219,6 +319,20 @@ class ReplView(object):
         else:
             self._logger = None
 
+        if settings.get("record_sessions") and repl.TYPE != "replay":
+            name = re.sub(r"[^\w.@-]", "_", self._repl_ip or repl.external_id or repl.TYPE)
+            filename = "%s-%s-%s.cast" % (name, time.strftime("%Y%m%d-%H%M%S"), repl.id[:8])
+            try:
+                repl.recorder = SessionRecorder(os.path.join(sublime.packages_path(), SESSION_DIR, filename),
+                                                repl._encoding, height=TERMINAL_HEIGHT,
+                                                title=self._repl_title or self._repl_ip,
+                                                record_input=settings.get("record_session_input", False))
+                self.call_on_close.append(lambda rv: rv.repl.recorder.close())
+            except Exception as e:
+                print(e)
+        # read only once the recorder is set, so the banner and first prompt are recorded
+        self._repl_reader.start()
+
         self._filter_color_codes = settings.get("filter_ascii_color_codes")
         self._emulate_ansi_csi = settings.get("emulate_ansi_csi")
         self._ansi_limit_cursor_up = settings.get("ansi_limit_cursor_up")
@@ -228,8 +342,9 @@ class ReplView(object):
                                                              terminal_height=TERMINAL_HEIGHT,
                                                              limit_cursor_up=self._ansi_limit_cursor_up)
             if not self._filter_color_codes:
-                ansi_color_utils.init_ansi_color(self)
+                ansi_color_utils.init_ansi_color(self, palette=settings.get("ansi_color_palette", False))
         self._ansi_escape_8bit_regex = ANSI_ESCAPE_8BIT_REGEX
+        self._filter_tail = ''
 
         # optionally move view to a different group
         # find current position of this replview
@@ -261,6 +376,13 @@ class ReplView(object):
     def external_id(self):
         return self.repl.external_id
 
+    @property
+    def host_name(self):
+        """user@ip of ssh repls, else the title or name of the repl"""
+        if self._repl_ip:
+            return "%s@%s" % (self._repl_user, self._repl_ip) if self._repl_user else self._repl_ip
+        return self._repl_title or self.repl.name()
+
     def on_backspace(self):
         if self.delta < 0:
             self._view.run_command("left_delete")
@@ -311,8 +433,11 @@ class ReplView(object):
 
     def clear(self, edit):
         self.escape(edit)
-        self._view.erase(edit, self.output_region)
+        output_region = self.output_region
+        self._view.erase(edit, output_region)
         self._output_end = self._view.sel()[0].begin()
+        if self._emulate_ansi_csi:
+            self._ansi_controller.view_erased(output_region.begin(), output_region.end())
 
     def escape(self, edit):
         self._view.set_read_only(False)
@@ -320,7 +445,15 @@ class ReplView(object):
         self._view.show(self.input_region)
 
     def enter(self):
+        command, location = self.take_input()
+        self.send_input(command, location)
+
+    def take_input(self, command=None):
+        """Submits the input, or command in its place, to history and the
+           view as enter does, returns the arguments for send_input"""
         v = self._view
+        if command is not None:
+            v.run_command("repl_replace_text", {"start": self._output_end, "end": v.size(), "text": command})
         if v.sel()[0].begin() != v.size():
             v.sel().clear()
             v.sel().add(sublime.Region(v.size()))
@@ -331,9 +464,13 @@ class ReplView(object):
         v.run_command("insert", {"characters": self.repl.cmd_postfix})
         command = self.user_input
         self.adjust_end()
+        return command, l
 
+    def send_input(self, command, location):
+        """Writes input taken by take_input to the repl, which can block on
+           a slow connection"""
         if self.repl.apiv2:
-            self.repl.write(command, location=l)
+            self.repl.write(command, location=location)
         else:
             self.repl.write(command)
 
@@ -367,6 +504,8 @@ class ReplView(object):
 
     def write(self, unistr):
         """Writes output from Repl into this view."""
+        for listener in tuple(self.output_listeners):
+            listener(self, unistr)
         if self._emulate_ansi_csi:
             try:
                 self._ansi_controller.run(unistr, debug=self._debug_ansi)
@@ -377,13 +516,17 @@ class ReplView(object):
         else:
             # remove color codes
             if self._filter_color_codes:
+                # hold back an escape cut off by the end of the packet
+                unistr = self._filter_tail + unistr
+                end = split_incomplete_escape(unistr)
+                unistr, self._filter_tail = unistr[:end], unistr[end:]
                 unistr = self._ansi_escape_8bit_regex.sub('', unistr)
                 unistr = ANSI_COLOR_REGEX.sub('', unistr)
 
             # string is assumed to be already correctly encoded
             self._view.run_command("repl_insert_text", {"pos": self._output_end - self._prompt_size, "text": unistr})
             self._output_end += len(unistr)
-        self._view.show(self.input_region)
+        self._is_frame_dirty = True
 
     def write_prompt(self, unistr):
         """Writes prompt from REPL into this view. Prompt is treated like
@@ -398,8 +541,10 @@ class ReplView(object):
         else:
             self._view.run_command("repl_insert_text", {"pos": self._view.size(), "text": text})
 
-    def get_view_text(self):
-        text = self._view.substr(sublime.Region(0, self._view.size()))
+    def get_view_text(self, start=0, end=None):
+        if end is None:
+            end = self._view.size()
+        text = self._view.substr(sublime.Region(start, end))
         return text
 
     def clear_queue(self):
@@ -409,23 +554,13 @@ class ReplView(object):
     def handle_repl_output(self):
         """Returns new data from Repl and bool indicating if Repl is still
            working"""
-        ret = True
-        text = ''
-        try:
-            while self.repl.is_alive():
-                packet = self._repl_reader.queue.get_nowait()
-                if packet is None:
-                    ret = False
-                    break
-                text += packet
-                if len(text) >= self._read_buffer:
-                    self.handle_repl_packet(text)
-                    text = ''
-        except queue.Empty:
-            pass
-        if len(text):
-            self.handle_repl_packet(text)
-        return ret
+        return drain_queue(self._repl_reader.queue, self._handle_repl_packets, self._read_buffer, self.repl.is_alive)
+
+    def _handle_repl_packets(self, packets):
+        if self.repl.apiv2:
+            self.handle_repl_packet([op for packet in packets for op in packet])
+        else:
+            self.handle_repl_packet(''.join(packets))
 
     def handle_repl_packet(self, packet):
         if self.repl.apiv2:
@@ -445,13 +580,40 @@ class ReplView(object):
         else:
             self.write(packet)
 
-    def _update_view_loop(self):
-        is_still_working = True
-        while is_still_working:
-            is_still_working = self.handle_repl_output()
-            sleep(0.01)
-
-        self.write("\n***Repl Killed***\n""" if self.repl._killed else "\n***Repl Closed***\n""")
+    def _update_view(self):
+        """Commits queued output to the view at most once per frame.
+           Output arriving after an idle period is drawn straight away so
+           interactive echo is not delayed, a steady stream is batched."""
+        if self._update_finished:
+            return
+        now = time.monotonic()
+        wait = self._last_frame + self._frame_interval - now
+        if wait > 0:
+            if not self._is_frame_scheduled:
+                self._is_frame_scheduled = True
+                VIEW_UPDATER.notify(self._update_view, delay=wait)
+            return
+        self._is_frame_scheduled = False
+        self._last_frame = now
+        left = drain_frame(self._repl_reader.queue, self._handle_repl_packets, self._read_buffer,
+                           self.repl.is_alive, lambda: self._repl_reader.finished)
+        if self._is_frame_dirty:
+            self._is_frame_dirty = False
+            self._trim_scrollback()
+            self._view.show(self.input_region)
+        if left == FRAME_MORE:
+            # frame budget spent, other views get a turn before the rest
+            self._is_frame_scheduled = True
+            VIEW_UPDATER.notify(self._update_view, delay=self._frame_interval)
+            return
+        if left == FRAME_IDLE:
+            return
+        self._update_finished = True
+        if self._repl_reader.connect_error is not None:
+            self.write("\n***Connection failed: %s***\n" % (self._repl_reader.connect_error,))
+        else:
+            self.write("\n***Repl Killed***\n""" if self.repl._killed else "\n***Repl Closed***\n""")
+        self._view.show(self.input_region)
         self._view.set_read_only(True)
         if self._view_auto_close:
             window = self._view.window()
@@ -459,9 +621,63 @@ class ReplView(object):
                 window.focus_view(self._view)
                 window.run_command("close")
 
+    def _scrollback_cut(self):
+        """Returns the position up to which old output should be erased,
+           always a line start and never past the text still being written"""
+        v = self._view
+        size = v.size()
+        cut = 0
+        if self._max_scrollback_bytes and size > self._max_scrollback_bytes * (1 + SCROLLBACK_TRIM_SLACK):
+            cut = size - self._max_scrollback_bytes
+            line = v.full_line(cut)
+            if line.begin() != cut:
+                cut = line.end()
+        if self._max_scrollback_lines:
+            n_lines = v.rowcol(size)[0] + 1
+            if n_lines > self._max_scrollback_lines * (1 + SCROLLBACK_TRIM_SLACK):
+                cut = max(cut, v.text_point(n_lines - self._max_scrollback_lines, 0))
+        if not cut:
+            return 0
+        limit = self._output_end - self._prompt_size
+        if self._emulate_ansi_csi:
+            limit = min(limit, self._ansi_controller._cursor_pos)
+        if cut > limit:
+            cut = v.line(limit).begin()
+        return cut
+
+    def _archive_scrollback(self, text):
+        try:
+            os.makedirs(os.path.dirname(self._scrollback_archive), exist_ok=True)
+            with gzip.open(self._scrollback_archive, "at", encoding="utf-8") as f:
+                f.write(text)
+        except Exception as e:
+            print(e)
+
+    def _trim_scrollback(self):
+        """Erases the head of the view once it grows past max_scrollback_lines
+           or max_scrollback_bytes, shifting every stored offset"""
+        if not (self._max_scrollback_lines or self._max_scrollback_bytes):
+            return
+        cut = self._scrollback_cut()
+        if cut <= 0:
+            return
+        if self._scrollback_archive:
+            self._archive_scrollback(self._view.substr(sublime.Region(0, cut)))
+        # highlights are shifted by sublime itself
+        self._view.run_command("repl_erase_text", {"start": 0, "end": cut})
+        self._output_end -= cut
+        if self._emulate_ansi_csi:
+            self._ansi_controller.view_erased(0, cut)
+
+    def _schedule_update_view(self):
+        VIEW_UPDATER.notify(self._update_view)
+
     def update_view_loop(self):
-        self._t = threading.Thread(target=self._update_view_loop)
-        self._t.start()
+        """Drains the reader whenever it reports new output, packets queued
+           before this call are picked up by the initial notify"""
+        self._update_finished = False
+        self._repl_reader.on_output = self._schedule_update_view
+        self._schedule_update_view()
 
     def push_history(self, command):
         self._history.push(command)
@@ -478,6 +694,10 @@ class ReplView(object):
         if self._history_match is None:
             self._history_match = self._history.match(user_input)
 
+    def search_history(self, query, limit=None):
+        """distinct commands containing every word of query, newest first"""
+        return self._history.search(query, limit)
+
     def replace_current_input(self, edit, cmd):
         if cmd:
             self._view.replace(edit, self.input_region, cmd)